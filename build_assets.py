@@ -0,0 +1,70 @@
+"""Build fingerprinted, precompressed copies of static assets.
+
+Writes static/dist/<name>.<hash><ext> plus .gz (and .br when the optional
+`brotli` package is installed) siblings, and static/dist/manifest.json that
+main.py's asset_url() uses to emit the hashed URLs.
+
+Usage:
+    python build_assets.py
+"""
+import gzip
+import hashlib
+import json
+import os
+
+try:
+    import brotli
+except ImportError:  # optional: only gzip variants are produced without it
+    brotli = None
+
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+ASSETS = ["chat.js", "style.css"]  # paths relative to STATIC_DIR
+HASH_LENGTH = 12
+
+
+def fingerprinted_name(name: str, content: bytes) -> str:
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+
+def write_file(path: str, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def build():
+    manifest = {}
+    produced = {"manifest.json"}
+    for name in ASSETS:
+        with open(os.path.join(STATIC_DIR, name), "rb") as f:
+            content = f.read()
+        hashed = fingerprinted_name(name, content)
+        target = os.path.join(DIST_DIR, hashed)
+
+        write_file(target, content)
+        # mtime=0 keeps .gz output byte-identical across builds
+        write_file(target + ".gz", gzip.compress(content, compresslevel=9, mtime=0))
+        produced.update({hashed, hashed + ".gz"})
+        if brotli is not None:
+            write_file(target + ".br", brotli.compress(content, quality=11))
+            produced.add(hashed + ".br")
+
+        manifest[name] = f"dist/{hashed}".replace(os.sep, "/")
+        print(f"[ASSETS] {name} -> {manifest[name]}")
+
+    # Drop outputs of previous builds
+    for entry in os.listdir(DIST_DIR):
+        if entry not in produced:
+            os.remove(os.path.join(DIST_DIR, entry))
+
+    write_file(os.path.join(DIST_DIR, "manifest.json"),
+               json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    if brotli is None:
+        print("[ASSETS] brotli not installed, skipped .br variants")
+
+
+if __name__ == "__main__":
+    build()
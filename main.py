@@ -1,19 +1,132 @@
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, Form
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, FileResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
+import os
+import stat
+import mimetypes
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timezone
 import uuid
 import asyncio
 import base64
 import json
+import random
+import signal
+import threading
+import time
+import hashlib
+import functools
+import contextvars
+import zlib
+from contextlib import contextmanager
+from collections import OrderedDict, Counter, deque
 from passlib.context import CryptContext
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+try:
+    import orjson
+except ImportError:  # listed in requirements.txt; stdlib json fallback for bare dev setups
+    orjson = None
+
+# -------------------- JSON --------------------
+if orjson is not None:
+    def dumps(obj) -> bytes:
+        """Compact UTF-8 JSON"""
+        return orjson.dumps(obj)
+else:
+    def dumps(obj) -> bytes:
+        """Compact UTF-8 JSON"""
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """Default response class, encoded with dumps()"""
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+def json_array(encoded_items) -> bytes:
+    """JSON array from already-encoded elements (e.g. SQLite json_object() rows)"""
+    return b"[" + b",".join(encoded_items) + b"]"
+
+def encode_frame(payload) -> str:
+    """Websocket text frame for payload; bytes from dumps()/json_array() are reused as-is"""
+    if isinstance(payload, str):
+        return payload
+    if not isinstance(payload, bytes):
+        payload = dumps(payload)
+    return payload.decode("utf-8")
+
+async def send_frame(websocket: WebSocket, payload):
+    """send_json() through the fast encoder"""
+    await websocket.send_text(encode_frame(payload))
+
+app = FastAPI(default_response_class=FastJSONResponse)
 templates = Jinja2Templates(directory="templates")
 
+# -------------------- Static assets --------------------
+ASSET_MANIFEST_PATH = os.path.join("static", "dist", "manifest.json")
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))  # preference order
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def load_asset_manifest():
+    """{logical name: fingerprinted path} written by build_assets.py; empty if not built"""
+    try:
+        with open(ASSET_MANIFEST_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+asset_manifest = load_asset_manifest()
+
+def asset_url(name: str) -> str:
+    """URL of a static asset, fingerprinted when build_assets.py has been run"""
+    return "/static/" + asset_manifest.get(name, name)
+
+def accepted_encodings(header: str):
+    """Content codings from an Accept-Encoding header, minus those with q=0"""
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves prebuilt .br/.gz siblings by Accept-Encoding
+    and marks fingerprinted files under dist/ as immutable"""
+
+    async def get_response(self, path: str, scope) -> Response:
+        response = None
+        if scope["method"] in ("GET", "HEAD"):
+            request_headers = Headers(scope=scope)
+            accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+            for encoding, suffix in PRECOMPRESSED_ENCODINGS:
+                if encoding not in accepted:
+                    continue
+                full_path, stat_result = self.lookup_path(path + suffix)
+                if stat_result and stat.S_ISREG(stat_result.st_mode):
+                    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                    response = FileResponse(full_path, stat_result=stat_result,
+                                            media_type=media_type, method=scope["method"])
+                    response.headers["Content-Encoding"] = encoding
+                    if self.is_not_modified(response.headers, request_headers):
+                        response = NotModifiedResponse(response.headers)
+                    break
+        if response is None:
+            response = await super().get_response(path, scope)
+
+        if path.startswith("dist/"):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        if path.startswith("dist/") or "content-encoding" in response.headers:
+            response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
+templates.env.globals["asset_url"] = asset_url
+
 # -------------------- DB --------------------
 USERS_DB = "users.db"
 CHAT_DB = "chathistory.db"
@@ -21,39 +134,388 @@ ROOMS_DB = "rooms.db"
 
 pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
 
+# -------------------- Tracing --------------------
+# Opt-in: MYCHAT_TRACE=1 times every query, data-access call and handler
+TRACE_ENABLED = os.environ.get("MYCHAT_TRACE", "") not in ("", "0")
+SLOW_QUERY_MS = float(os.environ.get("MYCHAT_SLOW_QUERY_MS", "50"))  # logged with EXPLAIN QUERY PLAN
+SLOW_REQUEST_MS = float(os.environ.get("MYCHAT_SLOW_REQUEST_MS", "200"))  # breakdown logged
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """Timed spans collected during one HTTP request or websocket message"""
+    __slots__ = ("name", "started", "spans")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []  # [(kind, label, duration_ms)]
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def totals(self):
+        """{(kind, label): [count, total_ms]}"""
+        totals = {}
+        for kind, label, duration in self.spans:
+            entry = totals.setdefault((kind, label), [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+        return totals
+
+    def report(self):
+        lines = [f"[TRACE] {self.name} {self.elapsed_ms():.1f} ms"]
+        ranked = sorted(self.totals().items(), key=lambda item: item[1][1], reverse=True)
+        for (kind, label), (count, total) in ranked:
+            lines.append(f"  {kind:<4} {total:8.1f} ms  x{count:<3} {label}")
+        return "\n".join(lines)
+
+    def server_timing(self):
+        """Server-Timing header value: time per span kind plus total"""
+        by_kind = {}
+        for kind, _, duration in self.spans:
+            by_kind[kind] = by_kind.get(kind, 0.0) + duration
+        parts = [f"{kind};dur={total:.1f}" for kind, total in by_kind.items()]
+        parts.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(parts)
+
+def record_span(kind: str, label: str, duration_ms: float):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.spans.append((kind, label, duration_ms))
+
+def traced(func):
+    """Time a data-access function as a span (no-op unless tracing is enabled)"""
+    if not TRACE_ENABLED:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_span("call", func.__name__, (time.perf_counter() - start) * 1000)
+    return wrapper
+
+@contextmanager
+def handler_trace(name: str, always_report: bool = False):
+    """Collect spans for one handler invocation; log the breakdown if slow"""
+    if not TRACE_ENABLED:
+        yield None
+        return
+    trace = Trace(name)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        current_trace.reset(token)
+        if always_report or trace.elapsed_ms() >= SLOW_REQUEST_MS:
+            print(trace.report())
+
+async def trace_http_request(request: Request, call_next):
+    """Per-request breakdown in a Server-Timing header; logged when slow or
+    when the request carries an X-Trace header"""
+    name = f"{request.method} {request.url.path}"
+    with handler_trace(name, always_report=bool(request.headers.get("x-trace"))) as trace:
+        response = await call_next(request)
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+def explain_query_plan(conn, sql: str, parameters):
+    try:
+        cur = sqlite3.Cursor(conn)  # plain cursor, not traced
+        cur.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+        return "; ".join(row[3] for row in cur.fetchall())
+    except Exception as e:
+        return f"unavailable ({e})"
+
+def record_query(conn, sql: str, parameters, start: float):
+    duration = (time.perf_counter() - start) * 1000
+    statement = " ".join(sql.split())
+    record_span("sql", statement[:100], duration)
+    if duration >= SLOW_QUERY_MS:
+        metrics["slow_queries"] += 1
+        plan = explain_query_plan(conn, sql, parameters) if parameters is not None else "n/a"
+        print(f"[SLOW QUERY] {duration:.1f} ms: {statement}\n  plan: {plan}")
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(self.connection, sql, parameters, start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # parameters were consumed, so no EXPLAIN for batches
+            record_query(self.connection, sql, None, start)
+
+class TracedConnection(sqlite3.Connection):
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def db_connect(path: str):
+    """Open a SQLite connection (query-timed when tracing is enabled)"""
+    if TRACE_ENABLED:
+        return sqlite3.connect(path, factory=TracedConnection)
+    return sqlite3.connect(path)
+
+if TRACE_ENABLED:
+    app.middleware("http")(trace_http_request)
+
+# -------------------- Message shards --------------------
+# Opt-in: MYCHAT_MESSAGE_SHARDS=N spreads room and private messages over N
+# database files so writes to different rooms/conversations don't share one lock.
+# A room or conversation always lives in a single shard, so its ids stay ordered.
+MESSAGE_SHARDS = int(os.environ.get("MYCHAT_MESSAGE_SHARDS", "0"))  # 0 = chathistory.db / rooms.db
+MESSAGE_SHARD_DB = "messages.{}.db"
+MIGRATION_BATCH = 5000
+
+def shard_path(key: str):
+    return MESSAGE_SHARD_DB.format(zlib.crc32(key.encode("utf-8")) % MESSAGE_SHARDS)
+
+def room_messages_db(room_id: str):
+    """Database file holding a room's messages"""
+    return shard_path("room:" + room_id) if MESSAGE_SHARDS else ROOMS_DB
+
+def direct_messages_db(name_a: str, name_b: str):
+    """Database file holding a conversation's messages and both read cursors"""
+    return shard_path("dm:" + conversation_key(name_a, name_b)) if MESSAGE_SHARDS else CHAT_DB
+
+def direct_message_dbs():
+    """Every database file that holds private messages"""
+    if MESSAGE_SHARDS:
+        return [MESSAGE_SHARD_DB.format(i) for i in range(MESSAGE_SHARDS)]
+    return [CHAT_DB]
+
+def create_direct_message_tables(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT,
+            receiver TEXT,
+            text TEXT,
+            timestamp TEXT,
+            read INTEGER DEFAULT 0
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (receiver, sender, id)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_receiver_ts
+        ON messages (receiver, timestamp)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_sender
+        ON messages (sender, receiver)
+    """)
+    # Read state: last message id `reader` has read from `peer`
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            reader TEXT NOT NULL,
+            peer TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (reader, peer)
+        )
+    """)
+
+def create_room_messages_table(c, references_rooms: bool = True):
+    # Shards can't reference rooms.db, so they carry no foreign key
+    foreign_key = ",\n            FOREIGN KEY (room_id) REFERENCES rooms(id) ON DELETE CASCADE" \
+        if references_rooms else ""
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS room_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            sender_name TEXT NOT NULL,
+            text TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            reply_to_sender_id TEXT,
+            reply_to_sender_name TEXT,
+            reply_to_text TEXT{foreign_key}
+        )
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_room_messages_room
+        ON room_messages (room_id, id)
+    """)
+
+def copy_rows_to_shards(source: str, select_sql: str, insert_sql: str, route, shard_conns: dict):
+    """Copy rows from an unsharded table into shards, keeping ids (so cursors stay valid).
+    insert_sql must be idempotent (OR IGNORE / OR REPLACE): a copy interrupted between shard
+    commits is simply run again on the next start"""
+    conn = db_connect(source)
+    try:
+        rows = conn.execute(select_sql)
+        while True:
+            batch = rows.fetchmany(MIGRATION_BATCH)
+            if not batch:
+                break
+            by_shard = {}
+            for row in batch:
+                by_shard.setdefault(route(row), []).append(row)
+            for path, shard_rows in by_shard.items():
+                shard_conns[path].executemany(insert_sql, shard_rows)
+    finally:
+        conn.close()
+
+def init_message_shards():
+    """Create shard files; on the first sharded start copy existing messages into them.
+    The shard count is recorded and can't change afterwards (ids would be re-routed)"""
+    conn = db_connect(CHAT_DB)
+    c = conn.cursor()
+    try:
+        c.execute("CREATE TABLE IF NOT EXISTS storage_meta (name TEXT PRIMARY KEY, value INTEGER)")
+        c.execute("SELECT value FROM storage_meta WHERE name='message_shards'")
+        row = c.fetchone()
+        configured = row[0] if row else 0
+        if configured == MESSAGE_SHARDS == 0:
+            return
+        if configured and configured != MESSAGE_SHARDS:
+            raise RuntimeError(f"message storage was created with MYCHAT_MESSAGE_SHARDS={configured}, "
+                               f"got {MESSAGE_SHARDS}")
+
+        shard_conns = {path: db_connect(path) for path in direct_message_dbs()}
+        try:
+            for shard in shard_conns.values():
+                create_direct_message_tables(shard.cursor())
+                create_room_messages_table(shard.cursor(), references_rooms=False)
+            if not configured:
+                print(f"[SHARDS] copying messages into {MESSAGE_SHARDS} shard(s)")
+                copy_rows_to_shards(
+                    CHAT_DB, "SELECT id, sender, receiver, text, timestamp, read FROM messages",
+                    "INSERT OR IGNORE INTO messages (id, sender, receiver, text, timestamp, read) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    lambda row: direct_messages_db(row[1], row[2]), shard_conns)
+                copy_rows_to_shards(
+                    CHAT_DB, "SELECT reader, peer, last_read_id FROM read_cursors",
+                    "INSERT OR REPLACE INTO read_cursors (reader, peer, last_read_id) VALUES (?, ?, ?)",
+                    lambda row: direct_messages_db(row[0], row[1]), shard_conns)
+                copy_rows_to_shards(
+                    ROOMS_DB, """SELECT id, room_id, sender_id, sender_name, text, timestamp,
+                                        reply_to_sender_id, reply_to_sender_name, reply_to_text
+                                 FROM room_messages""",
+                    """INSERT OR IGNORE INTO room_messages (id, room_id, sender_id, sender_name, text, timestamp,
+                                                            reply_to_sender_id, reply_to_sender_name, reply_to_text)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    lambda row: room_messages_db(row[1]), shard_conns)
+            for shard in shard_conns.values():
+                shard.commit()
+        finally:
+            for shard in shard_conns.values():
+                shard.close()
+        if not configured:
+            # Recorded only once every shard has committed; until then each start redoes the copy
+            c.execute("INSERT INTO storage_meta (name, value) VALUES ('message_shards', ?)", (MESSAGE_SHARDS,))
+            conn.commit()
+            print(f"[SHARDS] migration to {MESSAGE_SHARDS} shard(s) complete")
+    finally:
+        conn.close()
+
+# naive local ISO timestamp (full precision) -> now_timestamp() form; NULL if it doesn't parse
+LOCAL_TO_UTC_SQL = "strftime('%Y-%m-%dT%H:%M:%S', {0}, 'utc') || substr({0}, 20) || '+00:00'"
+LEGACY_TS_SQL = "length({0}) > 5 AND {0} NOT LIKE '%+00:00'"
+
+def convert_timestamps_to_utc():
+    """One-time rewrite of message timestamps stored as naive local time to UTC.
+    Idempotent (converted rows no longer match), so an interrupted run is simply repeated"""
+    conn = db_connect(CHAT_DB)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT value FROM storage_meta WHERE name='utc_timestamps'")
+        if c.fetchone():
+            return
+        tables = [(CHAT_DB, "messages"), (ROOMS_DB, "room_messages")]
+        if MESSAGE_SHARDS:
+            tables += [(path, table) for path in direct_message_dbs() for table in ("messages", "room_messages")]
+        for path, table in tables:
+            db = db_connect(path)
+            try:
+                db.execute(f"UPDATE {table} SET timestamp = COALESCE({LOCAL_TO_UTC_SQL.format('timestamp')}, timestamp) "
+                           f"WHERE {LEGACY_TS_SQL.format('timestamp')}")
+                db.commit()
+            finally:
+                db.close()
+        ts = "json_extract(payload, '$.ts')"
+        c.execute(f"UPDATE pending_notifications SET payload = json_set(payload, '$.ts', "
+                  f"COALESCE({LOCAL_TO_UTC_SQL.format(ts)}, {ts})) WHERE {LEGACY_TS_SQL.format(ts)}")
+        c.execute("INSERT INTO storage_meta (name, value) VALUES ('utc_timestamps', 1)")
+        conn.commit()
+    finally:
+        conn.close()
+
 def init_db():
     # users.db
-    conn = sqlite3.connect(USERS_DB)
+    conn = db_connect(USERS_DB)
     c = conn.cursor()
     c.execute("""
         CREATE TABLE IF NOT EXISTS users (
             id TEXT PRIMARY KEY,
             name TEXT UNIQUE,
             password_hash TEXT,
-            online INTEGER
+            online INTEGER,
+            name_key TEXT
         )
     """)
+    # name_key = casefolded name, for case-insensitive prefix search (added later)
+    c.execute("PRAGMA table_info(users)")
+    if "name_key" not in {row[1] for row in c.fetchall()}:
+        c.execute("ALTER TABLE users ADD COLUMN name_key TEXT")
+    c.execute("SELECT id, name FROM users WHERE name_key IS NULL")
+    c.executemany("UPDATE users SET name_key=? WHERE id=?",
+                  [(name_search_key(row[1]), row[0]) for row in c.fetchall()])
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_name_key
+        ON users (name_key, id)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_online_name_key
+        ON users (name_key, id) WHERE online=1
+    """)
     conn.commit()
     conn.close()
 
-    # chathistory.db (messages now has `read` flag)
-    conn = sqlite3.connect(CHAT_DB)
+    # chathistory.db (legacy `read` flag is superseded by read_cursors)
+    conn = db_connect(CHAT_DB)
     c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='read_cursors'")
+    cursors_existed = c.fetchone() is not None
+    create_direct_message_tables(c)
+    # Notifications for offline users that overflowed the in-memory queue
     c.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
+        CREATE TABLE IF NOT EXISTS pending_notifications (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender TEXT,
-            receiver TEXT,
-            text TEXT,
-            timestamp TEXT,
-            read INTEGER DEFAULT 0
+            user_id TEXT NOT NULL,
+            payload TEXT NOT NULL
         )
     """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_pending_notifications_user
+        ON pending_notifications (user_id, id)
+    """)
+    if not cursors_existed:
+        # One-time migration from per-row read flags
+        c.execute("""
+            INSERT OR IGNORE INTO read_cursors (reader, peer, last_read_id)
+            SELECT receiver, sender, MAX(id) FROM messages
+            WHERE read=1
+            GROUP BY receiver, sender
+        """)
     conn.commit()
     conn.close()
 
     # rooms.db - Rooms and room messages
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     # Rooms table
     c.execute("""
@@ -75,38 +537,36 @@ def init_db():
             FOREIGN KEY (room_id) REFERENCES rooms(id) ON DELETE CASCADE
         )
     """)
-    # Room messages table
     c.execute("""
-        CREATE TABLE IF NOT EXISTS room_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            room_id TEXT NOT NULL,
-            sender_id TEXT NOT NULL,
-            sender_name TEXT NOT NULL,
-            text TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            reply_to_sender_id TEXT,
-            reply_to_sender_name TEXT,
-            reply_to_text TEXT,
-            FOREIGN KEY (room_id) REFERENCES rooms(id) ON DELETE CASCADE
-        )
+        CREATE INDEX IF NOT EXISTS idx_room_members_user
+        ON room_members (user_id, room_id)
     """)
+    # Room messages table (unsharded storage)
+    create_room_messages_table(c)
     conn.commit()
     conn.close()
 
+    # messages.N.db - sharded room and private messages (MYCHAT_MESSAGE_SHARDS)
+    init_message_shards()
+    convert_timestamps_to_utc()
+
 # -------------------- Users SQLite --------------------
+@traced
 def add_user(user_id, name, password_hash):
-    conn = sqlite3.connect(USERS_DB)
+    conn = db_connect(USERS_DB)
     c = conn.cursor()
     try:
         # New users start as offline - will be set online when global WS connects
-        c.execute("INSERT OR IGNORE INTO users(id, name, password_hash, online) VALUES (?, ?, ?, ?)",
-                  (user_id, name, password_hash, 0))
+        c.execute("INSERT OR IGNORE INTO users(id, name, password_hash, online, name_key) VALUES (?, ?, ?, ?, ?)",
+                  (user_id, name, password_hash, 0, name_search_key(name)))
         conn.commit()
+        bump_version("users")
     finally:
         conn.close()
 
+@traced
 def set_user_online(user_id, online: bool):
-    conn = sqlite3.connect(USERS_DB)
+    conn = db_connect(USERS_DB)
     c = conn.cursor()
     try:
         c.execute("UPDATE users SET online=? WHERE id=?", (1 if online else 0, user_id))
@@ -114,18 +574,49 @@ def set_user_online(user_id, online: bool):
     finally:
         conn.close()
 
-def get_all_users():
-    conn = sqlite3.connect(USERS_DB)
+@traced
+def get_users_by_ids(user_ids):
+    """Get {id, name} for many users with a single query per chunk, in input order"""
+    users_by_id = {}
+    unique_ids = list(dict.fromkeys(user_ids))
+    if not unique_ids:
+        return []
+    conn = db_connect(USERS_DB)
     c = conn.cursor()
     try:
-        c.execute("SELECT id, name, online FROM users")
-        users = [{"id": row[0], "name": row[1], "online": bool(row[2])} for row in c.fetchall()]
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(unique_ids), 500):
+            chunk = unique_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            c.execute(f"SELECT id, name FROM users WHERE id IN ({placeholders})", chunk)
+            for row in c.fetchall():
+                users_by_id[row[0]] = {"id": row[0], "name": row[1]}
     finally:
         conn.close()
-    return users
+    return [users_by_id[uid] for uid in unique_ids if uid in users_by_id]
+
+@traced
+def get_user_ids_by_names(names):
+    """Ids for many user names, one query per chunk"""
+    names = list(set(names))
+    ids = []
+    if not names:
+        return ids
+    conn = db_connect(USERS_DB)
+    c = conn.cursor()
+    try:
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            c.execute(f"SELECT id FROM users WHERE name IN ({placeholders})", chunk)
+            ids.extend(row[0] for row in c.fetchall())
+    finally:
+        conn.close()
+    return ids
 
+@traced
 def get_user_by_name(name):
-    conn = sqlite3.connect(USERS_DB)
+    conn = db_connect(USERS_DB)
     c = conn.cursor()
     try:
         c.execute("SELECT id, name, password_hash, online FROM users WHERE name=?", (name,))
@@ -136,8 +627,9 @@ def get_user_by_name(name):
         conn.close()
     return None
 
+@traced
 def get_user_by_id(user_id):
-    conn = sqlite3.connect(USERS_DB)
+    conn = db_connect(USERS_DB)
     c = conn.cursor()
     try:
         c.execute("SELECT id, name, password_hash, online FROM users WHERE id=?", (user_id,))
@@ -148,6 +640,142 @@ def get_user_by_id(user_id):
         conn.close()
     return None
 
+# -------------------- User directory --------------------
+DIRECTORY_PAGE_SIZE = 50
+DIRECTORY_PAGE_MAX = 200
+MAX_WATCHED_USERS = 2000  # presence subscriptions per /ws/status socket (also caps the contact list)
+NAME_KEY_MAX = "\U0010ffff"  # sorts after any name_key character; upper bound for prefix ranges
+
+def name_search_key(name: str):
+    return (name or "").casefold()
+
+def encode_directory_cursor(user: dict):
+    raw = json.dumps([name_search_key(user["name"]), user["id"]], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_directory_cursor(cursor: str):
+    """(name_key, id) keyset position; ValueError if malformed"""
+    try:
+        name_key, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("invalid cursor")
+    if not isinstance(name_key, str) or not isinstance(user_id, str):
+        raise ValueError("invalid cursor")
+    return name_key, user_id
+
+@traced
+def get_related_user_ids(user: dict):
+    """Ids of users who share a room or a private conversation with user"""
+    conn = db_connect(ROOMS_DB)
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT DISTINCT other.user_id FROM room_members mine
+            JOIN room_members other ON other.room_id = mine.room_id
+            WHERE mine.user_id = ?
+        """, (user["id"],))
+        related = {row[0] for row in c.fetchall()}
+    finally:
+        conn.close()
+    peer_names = set()
+    for path in direct_message_dbs():
+        conn = db_connect(path)
+        c = conn.cursor()
+        try:
+            c.execute("""
+                SELECT DISTINCT sender FROM messages WHERE receiver = ?
+                UNION
+                SELECT DISTINCT receiver FROM messages WHERE sender = ?
+            """, (user["name"], user["name"]))
+            peer_names.update(row[0] for row in c.fetchall())
+        finally:
+            conn.close()
+    related.update(get_user_ids_by_names(peer_names))
+    related.discard(user["id"])
+    return related
+
+@traced
+def get_directory_users(user_ids):
+    """{id, name, online, name_key} for many users"""
+    user_ids = list(user_ids)
+    users = []
+    conn = db_connect(USERS_DB)
+    c = conn.cursor()
+    try:
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            c.execute(f"SELECT id, name, online, name_key FROM users WHERE id IN ({placeholders})", chunk)
+            users.extend({"id": row[0], "name": row[1], "online": bool(row[2]), "name_key": row[3]}
+                         for row in c.fetchall())
+    finally:
+        conn.close()
+    return users
+
+@traced
+def list_directory(viewer: dict, prefix: str = "", limit: int = DIRECTORY_PAGE_SIZE, cursor: str = None,
+                   online_only: bool = False, related_only: bool = False):
+    """One page of users ordered by (name_key, id), excluding the viewer.
+    prefix matches the start of the name case-insensitively; cursor continues a previous page.
+    Returns (users, next_cursor)"""
+    key_prefix = name_search_key(prefix)
+    after = decode_directory_cursor(cursor) if cursor else None
+
+    if related_only:
+        # Contacts are a small set: filter and page them in memory
+        users = [u for u in get_directory_users(get_related_user_ids(viewer))
+                 if u["name_key"].startswith(key_prefix)
+                 and (not online_only or u["online"])
+                 and (after is None or (u["name_key"], u["id"]) > after)]
+        users.sort(key=lambda u: (u["name_key"], u["id"]))
+        page = users[:limit + 1]
+    else:
+        # Range scan on idx_users_name_key (idx_users_online_name_key when online_only)
+        sql = """
+            SELECT id, name, online, name_key FROM users
+            WHERE name_key >= ? AND name_key < ? AND id != ?
+        """
+        # the cursor raises the lower bound so the index seek starts at the previous page's end
+        lower = max(key_prefix, after[0]) if after is not None else key_prefix
+        params = [lower, key_prefix + NAME_KEY_MAX, viewer["id"]]
+        if online_only:
+            sql += " AND online = 1"
+        if after is not None:
+            sql += " AND (name_key, id) > (?, ?)"
+            params.extend(after)
+        sql += " ORDER BY name_key, id LIMIT ?"
+        params.append(limit + 1)
+        conn = db_connect(USERS_DB)
+        c = conn.cursor()
+        try:
+            c.execute(sql, params)
+            page = [{"id": row[0], "name": row[1], "online": bool(row[2]), "name_key": row[3]}
+                    for row in c.fetchall()]
+        finally:
+            conn.close()
+
+    next_cursor = encode_directory_cursor(page[limit - 1]) if len(page) > limit else None
+    return [{"id": u["id"], "name": u["name"], "online": u["online"]} for u in page[:limit]], next_cursor
+
+@app.get("/api/users")
+async def api_list_users(request: Request):
+    """User directory: ?q= name prefix, ?online=1, ?related=1 (shares a room or chat with me),
+    ?limit=, and ?cursor= from the previous page's next_cursor"""
+    viewer = get_user_by_id(request.cookies.get("user_id") or "")
+    if not viewer:
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    params = request.query_params
+    limit = parse_int_param(params.get("limit"))
+    limit = DIRECTORY_PAGE_SIZE if limit is None else max(1, min(limit, DIRECTORY_PAGE_MAX))
+    try:
+        users, next_cursor = list_directory(
+            viewer, params.get("q", "").strip(), limit, params.get("cursor") or None,
+            online_only=params.get("online") in ("1", "true"),
+            related_only=params.get("related") in ("1", "true"))
+    except ValueError:
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+    return {"users": users, "next_cursor": next_cursor}
+
 # -------------------- Password --------------------
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -167,64 +795,564 @@ def decode_cookie_safe(value: str | None) -> str | None:
     except Exception:
         return None
 
-# -------------------- Chat --------------------
-connections = {}  # {user_id: {target_id: websocket}}
-user_status_connections = set()  # WS для обновления статусов
-global_connections = {}  # {user_id: websocket}
-room_connections = {}  # {room_id: {user_id: websocket}}
-
-async def broadcast_user_status():
-    # Update status based on actual connections
-    # Users with active global_connections are online
-    all_users = get_all_users()
-    # Create a set of actually connected user IDs
-    connected_user_ids = set(global_connections.keys())
-    
-    # Update database to reflect actual connection state
-    for user in all_users:
-        user_id = user["id"]
-        is_actually_online = user_id in connected_user_ids
-        # Only update if status differs to avoid unnecessary DB writes
-        if bool(user["online"]) != is_actually_online:
-            set_user_online(user_id, is_actually_online)
-            user["online"] = is_actually_online
-    
-    # Broadcast updated status to all status WebSocket clients
-    users_list = get_all_users()
-    for ws in list(user_status_connections):
+# -------------------- Versions & conditional GET --------------------
+BOOT_ID = uuid.uuid4().hex[:8]  # part of every ETag, so restarts invalidate them
+RESPONSE_CACHE_TTL = 30.0  # seconds an unused serialized response is kept
+RESPONSE_CACHE_MAX = 1024  # max cached responses (LRU)
+RESPONSE_CACHE_MAX_BYTES = int(float(os.environ.get("MYCHAT_RESPONSE_CACHE_MB", "16")) * 1024 * 1024)
+data_versions = {}  # {(kind, key): int}, bumped on every write that changes a response
+response_cache = OrderedDict()  # {cache_key: (etag, expires_at, body)}, least recently used first
+response_cache_bytes = 0
+
+def bump_version(kind: str, key: str = None):
+    data_versions[(kind, key)] = data_versions.get((kind, key), 0) + 1
+
+def get_version(kind: str, key: str = None):
+    return data_versions.get((kind, key), 0)
+
+def make_etag(*parts):
+    """Weak ETag from data versions and identifying strings"""
+    raw = ":".join(str(p) for p in (BOOT_ID,) + parts)
+    return 'W/"' + hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20] + '"'
+
+def etag_matches(request: Request, etag: str):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+def drop_cached_response(cache_key):
+    global response_cache_bytes
+    entry = response_cache.pop(cache_key, None)
+    if entry is not None:
+        response_cache_bytes -= len(entry[2])
+
+def cached_json_response(request: Request, etag: str, build, cache_key=None):
+    """Conditional GET for JSON: 304 if If-None-Match matches, otherwise the cached
+    body for cache_key if it is still at this etag, or a freshly built one"""
+    global response_cache_bytes
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if cache_key is None:
+        cache_key = (request.url.path, request.url.query)
+    now = time.monotonic()
+    # hits refresh the expiry and move to the end, so the front holds the oldest expiries
+    while response_cache and next(iter(response_cache.values()))[1] <= now:
+        drop_cached_response(next(iter(response_cache)))
+    entry = response_cache.get(cache_key)
+    if entry and entry[0] == etag:
+        body = entry[2]
+        response_cache[cache_key] = (etag, now + RESPONSE_CACHE_TTL, body)
+        response_cache.move_to_end(cache_key)
+    else:
+        body = build()
+        if not isinstance(body, bytes):
+            body = dumps(body)
+        # one entry per key: a new version replaces the old body
+        drop_cached_response(cache_key)
+        if len(body) <= RESPONSE_CACHE_MAX_BYTES // 8:  # large unpaged bodies aren't worth holding
+            response_cache[cache_key] = (etag, now + RESPONSE_CACHE_TTL, body)
+            response_cache_bytes += len(body)
+            while len(response_cache) > RESPONSE_CACHE_MAX or response_cache_bytes > RESPONSE_CACHE_MAX_BYTES:
+                drop_cached_response(next(iter(response_cache)))
+    return Response(body, media_type="application/json", headers=headers)
+
+def conversation_key(name_a: str, name_b: str):
+    """Order-independent key for a private conversation"""
+    return "\x00".join(sorted((name_a, name_b)))
+
+# -------------------- Messages --------------------
+REPLAY_LIMIT = 500  # max messages replayed to a reconnecting socket
+HISTORY_PAGE_SIZE = 50  # default page for ?limit=/?before= history requests
+HISTORY_PAGE_MAX = 500
+MAX_ROW_ID = 2 ** 63 - 1  # SQLite's largest rowid; "before" when none is given
+
+def now_timestamp():
+    """Full-precision UTC timestamp stored with messages and sent on the wire as `ts`.
+    Fixed-width, so string order is time order (also across DST changes)"""
+    return datetime.now(timezone.utc).isoformat(timespec="microseconds")
+
+def utc_cursor(value: str):
+    """Normalize a `ts` cursor from a client to now_timestamp() form; naive values (issued
+    before timestamps moved to UTC) are local time. None if it doesn't parse"""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return parsed.astimezone(timezone.utc).isoformat(timespec="microseconds")
+
+def display_time(timestamp: str):
+    """Local HH:MM for the UI (legacy rows already store HH:MM)"""
+    if timestamp and len(timestamp) > 5:
         try:
-            await ws.send_json(users_list)
-        except Exception:
-            user_status_connections.remove(ws)
+            return datetime.fromisoformat(timestamp).astimezone().strftime("%H:%M")
+        except ValueError:
+            pass
+    return timestamp
+
+# SQL twin of display_time()
+DISPLAY_TIME_SQL = ("CASE WHEN length(timestamp) > 5 "
+                    "THEN COALESCE(strftime('%H:%M', timestamp, 'localtime'), timestamp) ELSE timestamp END")
+
+def parse_int_param(value):
+    """Parse an integer query parameter (e.g. a `since` cursor), None if absent/invalid"""
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+@traced
+def save_direct_message(sender_name: str, receiver_name: str, text: str):
+    """Save private message, returns (id, timestamp)"""
+    conn = db_connect(direct_messages_db(sender_name, receiver_name))
+    c = conn.cursor()
+    try:
+        timestamp = now_timestamp()
+        c.execute(
+            "INSERT INTO messages (sender, receiver, text, timestamp, read) VALUES (?, ?, ?, ?, 0)",
+            (sender_name, receiver_name, text, timestamp)
+        )
+        conn.commit()
+        bump_version("dm", conversation_key(sender_name, receiver_name))
+        bump_version("unread", receiver_name)
+        return c.lastrowid, timestamp
+    finally:
+        conn.close()
+
+@traced
+def get_conversation(name_a: str, name_b: str, since_id: int = 0, limit: int = None):
+    """Messages between two users with id > since_id, oldest first"""
+    conn = db_connect(direct_messages_db(name_a, name_b))
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT id, sender, text, timestamp FROM messages
+            WHERE ((sender=? AND receiver=?) OR (sender=? AND receiver=?)) AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        """, (name_a, name_b, name_b, name_a, since_id, -1 if limit is None else limit))
+        return [{"id": row[0], "user": row[1], "text": row[2],
+                 "time": display_time(row[3]), "ts": row[3]} for row in c.fetchall()]
+    finally:
+        conn.close()
+
+@traced
+def get_conversation_json(name_a: str, name_b: str):
+    """Full conversation as JSON array bytes, rows encoded by SQLite (no per-row dicts)"""
+    conn = db_connect(direct_messages_db(name_a, name_b))
+    c = conn.cursor()
+    try:
+        c.execute(f"""
+            SELECT json_object('id', id, 'user', sender, 'text', text,
+                               'time', {DISPLAY_TIME_SQL}, 'ts', timestamp)
+            FROM messages
+            WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?)
+            ORDER BY id ASC
+        """, (name_a, name_b, name_b, name_a))
+        return json_array(row[0].encode("utf-8") for row in c.fetchall())
+    finally:
+        conn.close()
+
+@traced
+def get_conversation_page(name_a: str, name_b: str, limit: int, before: int = None):
+    """Newest `limit` messages between two users with id < before, oldest first"""
+    conn = db_connect(direct_messages_db(name_a, name_b))
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT id, sender, text, timestamp FROM messages
+            WHERE ((sender=? AND receiver=?) OR (sender=? AND receiver=?)) AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (name_a, name_b, name_b, name_a, MAX_ROW_ID if before is None else before, limit))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    return [{"id": row[0], "user": row[1], "text": row[2],
+             "time": display_time(row[3]), "ts": row[3]} for row in reversed(rows)]
+
+@traced
+def get_notifications_since(receiver_name: str, since_ts: str, limit: int = REPLAY_LIMIT):
+    """'notify' payloads for the newest `limit` private messages to receiver newer than since_ts,
+    oldest first"""
+    rows = []
+    for path in direct_message_dbs():
+        conn = db_connect(path)
+        c = conn.cursor()
+        try:
+            # length() skips legacy HH:MM rows, which predate any ts cursor
+            c.execute("""
+                SELECT id, sender, text, timestamp FROM messages
+                WHERE receiver=? AND timestamp > ? AND length(timestamp) > 5
+                ORDER BY timestamp DESC
+                LIMIT ?
+            """, (receiver_name, since_ts, limit))
+            rows.extend(c.fetchall())
+        finally:
+            conn.close()
+    # merge shards by time; older ones beyond the limit are only reflected in unread counts
+    rows.sort(key=lambda row: row[3])
+    rows = rows[-limit:]
+    sender_ids = {}
+    notifications = []
+    for msg_id, sender_name, text, timestamp in rows:
+        if sender_name not in sender_ids:
+            sender = get_user_by_name(sender_name)
+            sender_ids[sender_name] = sender["id"] if sender else sender_name
+        notifications.append({
+            "type": "notify",
+            "id": msg_id,
+            "from_id": sender_ids[sender_name],
+            "from_name": sender_name,
+            "text": text,
+            "time": display_time(timestamp),
+            "ts": timestamp
+        })
+    return notifications
+
+# -------------------- Connections --------------------
+class Connection:
+    """One open websocket and what it is attached to"""
+    __slots__ = ("websocket", "kind", "user_id", "target_id", "room_id", "watching")
+
+    def __init__(self, websocket: WebSocket, kind: str, user_id: str = None,
+                 target_id: str = None, room_id: str = None):
+        self.websocket = websocket
+        self.kind = kind  # "status" | "global" | "chat" | "room"
+        self.user_id = user_id
+        self.target_id = target_id
+        self.room_id = room_id
+        self.watching = set() if kind == "status" else None  # user ids whose presence is pushed
+
+class ConnectionRegistry:
+    """Every open socket, indexed by kind, user, conversation and room.
+    Buckets are insertion-ordered dicts used as sets: O(1) add/remove and
+    fan-out iterates only the sockets it needs. A user may hold any number
+    of sockets (tabs/devices) under each key"""
+
+    def __init__(self):
+        self.by_kind = {"status": {}, "global": {}, "chat": {}, "room": {}}
+        self.global_by_user = {}  # {user_id: {Connection: None}}
+        self.chat_by_pair = {}  # {(user_id, target_id): {Connection: None}}
+        self.room_by_id = {}  # {room_id: {Connection: None}}
+        self.room_by_member = {}  # {(room_id, user_id): {Connection: None}}
+        self.status_by_watched = {}  # {watched user_id: {Connection: None}}
+
+    @staticmethod
+    def _index_add(index: dict, key, conn: Connection):
+        bucket = index.get(key)
+        if bucket is None:
+            bucket = index[key] = {}
+        bucket[conn] = None
+
+    @staticmethod
+    def _index_remove(index: dict, key, conn: Connection):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(conn, None)
+            if not bucket:
+                del index[key]
+
+    def _indexes(self, conn: Connection):
+        if conn.kind == "global":
+            yield self.global_by_user, conn.user_id
+        elif conn.kind == "chat":
+            yield self.chat_by_pair, (conn.user_id, conn.target_id)
+        elif conn.kind == "room":
+            yield self.room_by_id, conn.room_id
+            yield self.room_by_member, (conn.room_id, conn.user_id)
+        elif conn.kind == "status":
+            for watched_id in conn.watching:
+                yield self.status_by_watched, watched_id
+
+    def add(self, websocket: WebSocket, kind: str, user_id: str = None,
+            target_id: str = None, room_id: str = None) -> Connection:
+        conn = Connection(websocket, kind, user_id, target_id, room_id)
+        self.by_kind[kind][conn] = None
+        for index, key in self._indexes(conn):
+            self._index_add(index, key, conn)
+        return conn
+
+    def remove(self, conn: Connection):
+        """Forget a connection; safe to call more than once"""
+        if self.by_kind[conn.kind].pop(conn, False) is False:
+            return
+        for index, key in self._indexes(conn):
+            self._index_remove(index, key, conn)
+
+    def watch(self, conn: Connection, user_ids):
+        """Subscribe a status connection to more users' presence (capped); returns the new ids"""
+        added = []
+        for user_id in user_ids:
+            if len(conn.watching) >= MAX_WATCHED_USERS:
+                break
+            if user_id not in conn.watching:
+                conn.watching.add(user_id)
+                self._index_add(self.status_by_watched, user_id, conn)
+                added.append(user_id)
+        return added
+
+    def watchers(self, user_id: str):
+        """Status sockets subscribed to user_id's presence"""
+        return list(self.status_by_watched.get(user_id, ()))
+
+    def global_for(self, user_id: str):
+        return list(self.global_by_user.get(user_id, ()))
+
+    def chat_for(self, user_id: str, target_id: str):
+        """Sockets on which user_id has the chat with target_id open"""
+        return list(self.chat_by_pair.get((user_id, target_id), ()))
+
+    def room(self, room_id: str):
+        return list(self.room_by_id.get(room_id, ()))
+
+    def room_member(self, room_id: str, user_id: str):
+        return list(self.room_by_member.get((room_id, user_id), ()))
+
+    def status(self):
+        return list(self.by_kind["status"])
+
+    def is_online(self, user_id: str) -> bool:
+        return user_id in self.global_by_user
+
+    def count(self, kind: str) -> int:
+        return len(self.by_kind[kind])
+
+    def all(self):
+        return [conn for bucket in self.by_kind.values() for conn in bucket]
+
+registry = ConnectionRegistry()
+
+async def send_to_connections(conns, payload: dict):
+    """Send payload to each connection, dropping the ones that fail.
+    Returns the number of successful sends"""
+    delivered = 0
+    frame = encode_frame(payload)  # encoded once for every recipient
+    for conn in conns:
+        try:
+            await conn.websocket.send_text(frame)
+            delivered += 1
+        except Exception as e:
+            print(f"[WARN] send to {conn.kind} socket of {conn.user_id} failed: {e}")
+            registry.remove(conn)
+    return delivered
+
+# -------------------- Recent messages cache --------------------
+RECENT_MESSAGES_PER_KEY = int(os.environ.get("MYCHAT_RECENT_MESSAGES", "200"))  # newest messages kept per room/DM
+RECENT_CACHE_MAX_BYTES = int(os.environ.get("MYCHAT_RECENT_CACHE_MB", "32")) * 1024 * 1024
+
+def approx_message_size(message: dict):
+    """Rough in-memory footprint of a message dict, for the cache memory cap"""
+    size = 240  # dict + fixed fields
+    for value in message.values():
+        if isinstance(value, str):
+            size += 49 + len(value)
+        elif isinstance(value, dict):
+            size += approx_message_size(value)
+    return size
+
+class RecentBuffer:
+    """Ring buffer of the newest messages of one room/conversation, oldest first.
+    Everything with id >= the oldest buffered id is present; `complete` means
+    there is nothing older either"""
+    __slots__ = ("messages", "complete", "size")
+
+    def __init__(self, maxlen: int):
+        self.messages = deque(maxlen=maxlen)
+        self.complete = False
+        self.size = 0
+
+class RecentMessages:
+    """LRU of ring buffers for hot rooms and conversations, capped per key and in total bytes.
+    Filled on write by the websocket handlers and seeded from first-page reads"""
+
+    def __init__(self, per_key: int, max_bytes: int):
+        self.per_key = per_key
+        self.max_bytes = max_bytes
+        self.buffers = OrderedDict()  # {key: RecentBuffer}
+        self.total_bytes = 0
+
+    def _push(self, buffer: RecentBuffer, message: dict):
+        if len(buffer.messages) == buffer.messages.maxlen:
+            dropped = buffer.messages.popleft()
+            dropped_size = approx_message_size(dropped)
+            buffer.size -= dropped_size
+            self.total_bytes -= dropped_size
+            buffer.complete = False
+        buffer.messages.append(message)
+        message_size = approx_message_size(message)
+        buffer.size += message_size
+        self.total_bytes += message_size
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self.buffers) > 1:
+            _, buffer = self.buffers.popitem(last=False)
+            self.total_bytes -= buffer.size
+
+    def append(self, key, message: dict):
+        """Record a message that was just saved"""
+        if self.per_key <= 0:
+            return
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            # Nothing known about older history yet
+            buffer = self.buffers[key] = RecentBuffer(self.per_key)
+        else:
+            self.buffers.move_to_end(key)
+        self._push(buffer, message)
+        self._evict()
+
+    def fill(self, key, messages: list, complete: bool):
+        """Replace a key's buffer with the newest page read from the database"""
+        if self.per_key <= 0:
+            return
+        self.discard(key)
+        buffer = self.buffers[key] = RecentBuffer(self.per_key)
+        for message in messages[-self.per_key:]:
+            self._push(buffer, message)
+        buffer.complete = complete and len(messages) <= self.per_key
+        self._evict()
+
+    def discard(self, key):
+        buffer = self.buffers.pop(key, None)
+        if buffer is not None:
+            self.total_bytes -= buffer.size
+
+    def page(self, key, limit: int, before: int = None):
+        """Newest `limit` messages with id < before, or None if the buffer can't answer"""
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            metrics["recent_cache_misses"] += 1
+            return None
+        older = [m for m in buffer.messages if before is None or m["id"] < before]
+        if len(older) < limit and not buffer.complete:
+            metrics["recent_cache_misses"] += 1
+            return None
+        self.buffers.move_to_end(key)
+        metrics["recent_cache_hits"] += 1
+        return older[-limit:]
+
+    def since(self, key, since_id: int, limit: int):
+        """Oldest `limit` messages with id > since_id, or None if some may be missing"""
+        buffer = self.buffers.get(key)
+        if buffer is None or not buffer.messages:
+            return None
+        if not buffer.complete and since_id < buffer.messages[0]["id"]:
+            return None
+        self.buffers.move_to_end(key)
+        return [m for m in buffer.messages if m["id"] > since_id][:limit]
+
+recent_messages = RecentMessages(RECENT_MESSAGES_PER_KEY, RECENT_CACHE_MAX_BYTES)
+
+def recent_page(key, limit: int, before: int, fetch):
+    """History page from the recent-messages cache, falling back to fetch(limit, before)"""
+    page = recent_messages.page(key, limit, before)
+    if page is None:
+        page = fetch(limit, before)
+        if before is None:
+            recent_messages.fill(key, page, complete=len(page) < limit)
+    return page
+
+def recent_since(key, since_id: int, fetch):
+    """Replay frame for messages after since_id, from the cache or fetch(since_id, limit).
+    Returns None when nothing was missed. More than REPLAY_LIMIT missed messages are not
+    replayed: the frame is an empty gap marker ("truncated") and the client reloads history"""
+    missed = recent_messages.since(key, since_id, REPLAY_LIMIT + 1)
+    if missed is None:
+        missed = fetch(since_id, REPLAY_LIMIT + 1)
+    if len(missed) > REPLAY_LIMIT:
+        metrics["replays_truncated"] += 1
+        return {"type": "replay", "messages": [], "truncated": True}
+    return {"type": "replay", "messages": missed} if missed else None
+
+def parse_history_page(request: Request):
+    """(limit, before) from ?limit=&before=; limit is None when neither is given (full history)"""
+    limit = parse_int_param(request.query_params.get("limit"))
+    before = parse_int_param(request.query_params.get("before"))
+    if limit is None and before is None:
+        return None, None
+    limit = HISTORY_PAGE_SIZE if limit is None else max(1, min(limit, HISTORY_PAGE_MAX))
+    return limit, before
+
+# -------------------- Chat --------------------
+
+async def broadcast_presence(user: dict, online: bool):
+    """Push a presence change to the status sockets watching this user"""
+    await send_to_connections(registry.watchers(user["id"]), {
+        "type": "presence",
+        "users": [{"id": user["id"], "name": user["name"], "online": online}]
+    })
 
 @app.websocket("/ws/status")
 async def user_status_ws(websocket: WebSocket):
+    """Presence of the viewer's contacts: one "contacts" snapshot, then "presence" deltas.
+    The client adds users with {"type": "watch", "ids": [...]} (e.g. opened from search)"""
+    if await refuse_if_shutting_down(websocket):
+        return
     await websocket.accept()
-    user_status_connections.add(websocket)
-    await broadcast_user_status()
+    viewer = get_user_by_id(websocket.cookies.get("user_id") or "")
+    if not viewer:
+        await websocket.close(code=1008, reason="Not authenticated")
+        return
+    contacts, _ = list_directory(viewer, limit=MAX_WATCHED_USERS, related_only=True)
+    conn = registry.add(websocket, "status", viewer["id"])
+    registry.watch(conn, [u["id"] for u in contacts])
     try:
+        await send_frame(websocket, {"type": "contacts", "users": contacts})
         while True:
-            await asyncio.sleep(10)
+            data = await websocket.receive_text()
+            try:
+                msg = json.loads(data)
+            except ValueError:
+                continue
+            if not isinstance(msg, dict) or msg.get("type") != "watch" or not isinstance(msg.get("ids"), list):
+                continue
+            added = registry.watch(conn, [i for i in msg["ids"] if isinstance(i, str)])
+            if added:
+                users = [{"id": u["id"], "name": u["name"], "online": registry.is_online(u["id"])}
+                         for u in get_users_by_ids(added)]
+                await send_frame(websocket, {"type": "presence", "users": users})
     except WebSocketDisconnect:
-        user_status_connections.remove(websocket)
+        pass
+    finally:
+        registry.remove(conn)
 
 @app.websocket("/ws/global/{user_id}")
 async def global_ws(websocket: WebSocket, user_id: str):
+    if await refuse_if_shutting_down(websocket):
+        return
     await websocket.accept()
-    # запоминаем глобальное соединение (один ws на пользователя)
-    # If there's already a connection for this user, close it first
-    if user_id in global_connections:
+    user = get_user_by_id(user_id)
+    # запоминаем глобальное соединение (по одному на каждую вкладку/устройство)
+    was_online = registry.is_online(user_id)
+    conn = registry.add(websocket, "global", user_id)
+    # Set user as online when their first global connection is established
+    if not was_online:
+        set_user_online(user_id, True)
+        if user:
+            await broadcast_presence(user, True)
+
+    # Catch-up in one frame: notifications queued while offline, anything missed
+    # since the client's last seen `ts` (another device may have been online), and unread counts
+    if user:
+        notifications = take_pending_notifications(user_id)
+        since_ts = utc_cursor(websocket.query_params.get("since") or "")
+        truncated = False
+        if since_ts:
+            missed = get_notifications_since(user["name"], since_ts, REPLAY_LIMIT + 1)
+            truncated = len(missed) > REPLAY_LIMIT
+            notifications = merge_notifications(notifications, missed[-REPLAY_LIMIT:])
+        batch = {"type": "notify_batch", "notifications": notifications, "unread": get_unread_counts(user)}
+        if truncated:
+            # only the newest were sent; the unread counts still cover the rest
+            batch["truncated"] = True
         try:
-            old_ws = global_connections[user_id]
-            await old_ws.close()
-        except Exception:
-            pass
-        del global_connections[user_id]
-    
-    global_connections[user_id] = websocket
-    # Set user as online when they establish global connection
-    set_user_online(user_id, True)
-    await broadcast_user_status()
+            await send_frame(websocket, batch)
+        except Exception as e:
+            print(f"[WS GLOBAL] Catch-up failed for {user_id}: {e}")
     
     try:
         while True:
@@ -245,7 +1373,7 @@ async def global_ws(websocket: WebSocket, user_id: str):
             except asyncio.TimeoutError:
                 # Timeout - send ping to check if connection is alive
                 try:
-                    await websocket.send_json({"type": "ping"})
+                    await send_frame(websocket, {"type": "ping"})
                 except Exception as e:
                     # Connection is dead, break the loop
                     print(f"[WS GLOBAL] Ping failed for {user_id}: {e}")
@@ -262,12 +1390,121 @@ async def global_ws(websocket: WebSocket, user_id: str):
     except Exception as e:
         print(f"[WS GLOBAL] Unexpected error for {user_id}: {e}")
     finally:
-        # Clean up: remove from connections and set offline
-        if user_id in global_connections and global_connections[user_id] == websocket:
-            del global_connections[user_id]
-        # Set user as offline when they disconnect
-        set_user_online(user_id, False)
-        await broadcast_user_status()
+        # Clean up: remove this socket; the user stays online while another device is connected
+        registry.remove(conn)
+        # While draining, skip the per-user offline write and status fan-out (startup resets everyone anyway)
+        if not registry.is_online(user_id) and not shutting_down:
+            set_user_online(user_id, False)
+            if user:
+                await broadcast_presence(user, False)
+
+# -------------------- Flood control --------------------
+# Token buckets: RATE messages/second refilled up to BURST; a rate of 0 disables the limit
+USER_MSG_RATE = float(os.environ.get("MYCHAT_USER_MSG_RATE", "5"))  # per user, across all sockets
+USER_MSG_BURST = float(os.environ.get("MYCHAT_USER_MSG_BURST", "10"))
+ROOM_MSG_RATE = float(os.environ.get("MYCHAT_ROOM_MSG_RATE", "50"))  # per room, all senders
+ROOM_MSG_BURST = float(os.environ.get("MYCHAT_ROOM_MSG_BURST", "100"))
+MAX_MESSAGE_DELAY = float(os.environ.get("MYCHAT_MAX_MESSAGE_DELAY", "1.0"))  # longer waits are rejected
+MAX_MESSAGE_LENGTH = int(os.environ.get("MYCHAT_MAX_MESSAGE_LENGTH", "4000"))  # characters
+
+metrics = Counter()  # exposed via /api/metrics
+user_buckets = {}  # {user_id: TokenBucket}
+room_buckets = {}  # {room_id: TokenBucket}
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Seconds until one token is available (0 if available now)"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        # May go negative: that is a reservation the next wait_time accounts for
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def is_idle(self):
+        """Full bucket - nothing to remember, can be dropped"""
+        if self.rate <= 0:
+            return True
+        self._refill()
+        return self.tokens >= self.capacity
+
+def get_bucket(buckets: dict, key: str, rate: float, burst: float):
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = TokenBucket(rate, burst)
+    return bucket
+
+async def admit_message(user_id: str, room_id: str = None):
+    """Apply per-user (and per-room) token buckets to one incoming message.
+    Short overflows are delayed; returns None once admitted, or the retry-after
+    in seconds if the message is rejected"""
+    buckets = [get_bucket(user_buckets, user_id, USER_MSG_RATE, USER_MSG_BURST)]
+    if room_id:
+        buckets.append(get_bucket(room_buckets, room_id, ROOM_MSG_RATE, ROOM_MSG_BURST))
+    wait = max(b.wait_time() for b in buckets)
+    if wait > MAX_MESSAGE_DELAY:
+        metrics["messages_rejected_rate"] += 1
+        return wait
+    for b in buckets:
+        b.consume()
+    if wait > 0:
+        metrics["messages_delayed"] += 1
+        record_span("wait", "rate limit", wait * 1000)
+        await asyncio.sleep(wait)
+    metrics["messages_accepted"] += 1
+    return None
+
+async def reject_too_long(websocket: WebSocket):
+    metrics["messages_rejected_size"] += 1
+    await send_frame(websocket, {"type": "error", "error": "message_too_long",
+                                 "max_length": MAX_MESSAGE_LENGTH})
+
+async def check_incoming_message(websocket: WebSocket, text: str, user_id: str, room_id: str = None):
+    """Size cap and rate limit for a received message; sends an error frame
+    and returns False if it must be dropped"""
+    if len(text) > MAX_MESSAGE_LENGTH:
+        await reject_too_long(websocket)
+        return False
+    retry_after = await admit_message(user_id, room_id)
+    if retry_after is not None:
+        await send_frame(websocket, {"type": "error", "error": "rate_limited",
+                                     "retry_after_ms": int(retry_after * 1000)})
+        return False
+    return True
+
+def prune_idle_buckets():
+    for buckets in (user_buckets, room_buckets):
+        for key, bucket in list(buckets.items()):
+            if bucket.is_idle():
+                del buckets[key]
+
+@app.get("/api/metrics")
+async def api_metrics(request: Request):
+    """Counters and current connection counts (signed-in users only)"""
+    if not get_user_by_id(request.cookies.get("user_id") or ""):
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    return {
+        "counters": dict(metrics),
+        "connections": {kind: registry.count(kind) for kind in registry.by_kind},
+        "online_users": len(registry.global_by_user),
+        "pending_notifications": {"in_memory": pending_in_memory, "spilled_users": len(spilled_users)}
+    }
 
 # -------------------- Periodic Cleanup --------------------
 async def periodic_connection_cleanup():
@@ -279,22 +1516,109 @@ async def periodic_connection_cleanup():
         # The global_ws handler already manages connection health with pings
         # We don't need to ping here - that would interfere with the handler
         # This cleanup is just a safety net for edge cases
-        pass  # Removed aggressive ping checking - let global_ws handle it
+        # Forget rate-limit state for senders that have gone quiet
+        prune_idle_buckets()
+
+# -------------------- Shutdown --------------------
+SHUTDOWN_BATCH_SIZE = 200  # sockets closed per batch while draining
+SHUTDOWN_BATCH_DELAY = 0.05  # seconds between close batches
+RECONNECT_HINT_MS = (1000, 15000)  # jittered reconnect delay range suggested to clients
+shutting_down = False  # set once draining starts; new sockets are refused
+_drain_task = None
+
+def all_open_websockets():
+    """Snapshot of every tracked websocket"""
+    return [conn.websocket for conn in registry.all()]
+
+async def refuse_if_shutting_down(websocket: WebSocket):
+    """Reject a new socket while draining; returns True if it was refused"""
+    if not shutting_down:
+        return False
+    await websocket.close(code=1012)
+    return True
+
+async def drain_connections():
+    """Stop accepting sockets, hint clients to reconnect with jitter,
+    flush pending writes, then close sockets in controlled batches"""
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    sockets = all_open_websockets()
+    print(f"[SHUTDOWN] draining {len(sockets)} websocket(s)")
+
+    # Spread reconnects out so the next instance doesn't get them all at once
+    for ws in sockets:
+        try:
+            await send_frame(ws, {"type": "reconnect", "retry_after_ms": random.randint(*RECONNECT_HINT_MS)})
+        except Exception:
+            pass
+
+    await flush_pending_mark_reads()
+    flush_pending_notifications()
+
+    for i in range(0, len(sockets), SHUTDOWN_BATCH_SIZE):
+        for ws in sockets[i:i + SHUTDOWN_BATCH_SIZE]:
+            try:
+                await ws.close(code=1012, reason="Server restarting")
+            except Exception:
+                pass
+        await asyncio.sleep(SHUTDOWN_BATCH_DELAY)
+    print("[SHUTDOWN] drain complete")
+
+def install_drain_signal_handlers():
+    """Run drain_connections before the server's own SIGTERM/SIGINT handling.
+    Uvicorn drops sockets before the shutdown event fires, so the drain has to start first"""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+
+    async def drain_then_exit(previous, signum, frame):
+        try:
+            await drain_connections()
+        finally:
+            previous(signum, frame)
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if not callable(previous):
+            continue
+
+        def handler(signum, frame, previous=previous):
+            global _drain_task
+            if _drain_task is None:
+                _drain_task = loop.create_task(drain_then_exit(previous, signum, frame))
+            else:
+                # Second signal: let the server handle it (e.g. force quit)
+                previous(signum, frame)
+
+        signal.signal(sig, handler)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # No-op if a signal already triggered the drain
+    await drain_connections()
+    await flush_pending_mark_reads()
+    flush_pending_notifications()
 
 # -------------------- Startup --------------------
 @app.on_event("startup")
 async def startup_event():
+    if orjson is None:
+        print("[JSON] orjson is not installed, falling back to stdlib json (pip install -r requirements.txt)")
     init_db()
     # Set all users offline on startup (they'll be set online when they connect)
-    conn = sqlite3.connect(USERS_DB)
+    conn = db_connect(USERS_DB)
     c = conn.cursor()
     try:
         c.execute("UPDATE users SET online=0")
         conn.commit()
     finally:
         conn.close()
+    load_spilled_users()
     # Start periodic cleanup task
     asyncio.create_task(periodic_connection_cleanup())
+    install_drain_signal_handlers()
 
 # -------------------- Routes --------------------
 @app.get("/", response_class=HTMLResponse)
@@ -323,7 +1647,6 @@ async def register(username: str = Form(...), password: str = Form(...)):
     response = RedirectResponse("/index", status_code=303)
     response.set_cookie("user_id", user_id)
     response.set_cookie("username", encode_cookie(username))
-    await broadcast_user_status()
     return response
 
 @app.post("/login")
@@ -343,9 +1666,10 @@ async def login(username: str = Form(...), password: str = Form(...)):
 @app.get("/logout")
 async def logout(request: Request):
     user_id = request.cookies.get("user_id")
-    if user_id:
+    user = get_user_by_id(user_id) if user_id else None
+    if user:
         set_user_online(user_id, False)
-    await broadcast_user_status()
+        await broadcast_presence(user, False)
     response = RedirectResponse("/", status_code=303)
     response.delete_cookie("user_id")
     response.delete_cookie("username")
@@ -374,87 +1698,69 @@ async def chat_page(request: Request, target_id: str):
         "target_id": target_id
     })
 
-# Note: connections is already defined above at line 127
-
 # -------------------- WebSocket чат --------------------
 @app.websocket("/ws/{user_id}/{target_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str, target_id: str):
+    if await refuse_if_shutting_down(websocket):
+        return
     await websocket.accept()
-    # защитим структуру (если ещё нет - создаём dict)
-    if user_id not in connections:
-        connections[user_id] = {}
-    connections[user_id][target_id] = websocket
 
     sender_info = get_user_by_id(user_id)
     receiver_info = get_user_by_id(target_id)
     sender = sender_info["name"] if sender_info else user_id
     receiver = receiver_info["name"] if receiver_info else target_id
 
+    # Resume: collect messages missed since the client's last seen id before
+    # registering, so anything saved afterwards is delivered live
+    since_id = parse_int_param(websocket.query_params.get("since"))
+    dm_key = ("dm", conversation_key(sender, receiver))
+    replay = recent_since(dm_key, since_id, lambda since, limit: get_conversation(sender, receiver, since, limit)) \
+        if since_id is not None else None
+
+    conn = registry.add(websocket, "chat", user_id, target_id)
+
     print(f"[WS CONNECT] {user_id} -> {target_id}")  # лог подключения
+    if replay:
+        await send_frame(websocket, replay)
 
     try:
         while True:
             data = await websocket.receive_text()
-            print(f"[WS RECV] from {user_id} to {target_id}: {data}")
-            timestamp = datetime.now().strftime("%H:%M")
-            message_data = {"user": sender, "text": data, "time": timestamp}
-
-            # сохраняем в SQLite (read=0)
-            conn = sqlite3.connect(CHAT_DB)
-            c = conn.cursor()
-            c.execute(
-                "INSERT INTO messages (sender, receiver, text, timestamp, read) VALUES (?, ?, ?, ?, 0)",
-                (sender, receiver, data, timestamp)
-            )
-            conn.commit()
-            conn.close()
-
-            # --- notify global ws for recipient (so client will increment unread) ---
-            notif = {
-                "type": "notify",
-                "from_id": user_id,
-                "from_name": sender,
-                "text": data,
-                "time": timestamp
-            }
-            if target_id in global_connections:
-                try:
-                    await global_connections[target_id].send_json(notif)
-                except Exception as e:
-                    print(f"[WARN] failed to notify global_connections[{target_id}]: {e}")
+            with handler_trace(f"WS /ws/{user_id}/{target_id}"):
+                print(f"[WS RECV] from {user_id} to {target_id}: {data}")
+                if not await check_incoming_message(websocket, data, user_id):
+                    continue
+                # сохраняем в SQLite
+                message_id, timestamp = save_direct_message(sender, receiver, data)
+                message_data = {"id": message_id, "user": sender, "text": data,
+                                "time": display_time(timestamp), "ts": timestamp}
+                recent_messages.append(dm_key, message_data)
+
+                # --- notify global ws for recipient (so client will increment unread) ---
+                notif = {
+                    "type": "notify",
+                    "id": message_id,
+                    "from_id": user_id,
+                    "from_name": sender,
+                    "text": data,
+                    "time": display_time(timestamp),
+                    "ts": timestamp
+                }
+                # queue only for real accounts: target_id comes straight from the URL
+                if not await send_to_global(target_id, notif) and receiver_info:
+                    queue_notification(target_id, notif)
 
-            # отправляем получателю - только в его приватный чат с отправителем
-            # connections[target_id][user_id] - это WS где target_id чатит с user_id
-            if target_id in connections and user_id in connections[target_id]:
-                try:
-                    ws = connections[target_id][user_id]
-                    await ws.send_json(message_data)
-                except Exception as e:
-                    print(f"[WARN] send to connections[{target_id}][{user_id}] failed: {e}")
-                    # при ошибке — удаляем это ws
-                    try:
-                        del connections[target_id][user_id]
-                        if not connections[target_id]:
-                            del connections[target_id]
-                    except Exception:
-                        pass
-
-            # эхо для отправителя (чтобы он увидел своё сообщение)
-            try:
-                await websocket.send_json(message_data)
-            except Exception as e:
-                print(f"[WARN] echo send to sender {user_id}->{target_id} failed: {e}")
+                # отправляем получателю - только в его приватный чат с отправителем,
+                # и эхо отправителю на все его устройства с этим чатом (включая текущее)
+                recipients = registry.chat_for(target_id, user_id)
+                if target_id != user_id:
+                    recipients += registry.chat_for(user_id, target_id)
+                await send_to_connections(recipients, message_data)
 
     except WebSocketDisconnect:
         # аккуратно убираем соединение (если оно ещё есть)
         print(f"[WS DISCONNECT] {user_id} -> {target_id}")
-        try:
-            if user_id in connections and target_id in connections[user_id]:
-                del connections[user_id][target_id]
-                if not connections[user_id]:
-                    del connections[user_id]
-        except Exception as e:
-            print(f"[ERROR] cleaning connections after disconnect: {e}")
+        registry.remove(conn)
         try:
             await websocket.close()
         except Exception:
@@ -462,14 +1768,7 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, target_id: str)
         await asyncio.sleep(0.1)
     except Exception as exc:
         print(f"[ERROR] websocket_endpoint exception {user_id}->{target_id}: {exc}")
-        # попытка очистки
-        try:
-            if user_id in connections and target_id in connections[user_id]:
-                del connections[user_id][target_id]
-                if not connections[user_id]:
-                    del connections[user_id]
-        except Exception as e:
-            print(f"[ERROR] cleanup after exception: {e}")
+        registry.remove(conn)
         try:
             await websocket.close()
         except Exception:
@@ -478,41 +1777,222 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str, target_id: str)
 
 # -------------------- История --------------------
 @app.get("/history/{user_id}/{target_id}")
-async def get_history(user_id: str, target_id: str):
+async def get_history(request: Request, user_id: str, target_id: str):
     sender_user = get_user_by_id(user_id)
     receiver_user = get_user_by_id(target_id)
     if not sender_user or not receiver_user:
         return []
 
-    conn = sqlite3.connect(CHAT_DB)
+    name_a, name_b = sender_user["name"], receiver_user["name"]
+    key = conversation_key(name_a, name_b)
+    limit, before = parse_history_page(request)
+    etag = make_etag("history", key, get_version("dm", key), limit, before)
+    if limit is None:
+        return cached_json_response(request, etag, lambda: get_conversation_json(name_a, name_b))
+    return cached_json_response(request, etag, lambda: recent_page(
+        ("dm", key), limit, before,
+        lambda limit, before: get_conversation_page(name_a, name_b, limit, before)))
+
+# -------------------- Read cursors --------------------
+MARK_READ_DEBOUNCE = 0.5  # seconds; repeated mark_read calls within this window are coalesced
+pending_mark_reads = {}  # {(user_id, target_id): (task, user_name, target_name)}
+pending_read_ids = {}  # {(user_id, target_id): highest message id the reader has seen}
+
+@traced
+def latest_message_id(reader_name: str, peer_name: str):
+    """Id of the newest message from peer to reader, 0 if none"""
+    conn = db_connect(direct_messages_db(reader_name, peer_name))
     c = conn.cursor()
-    c.execute("""
-        SELECT sender, text, timestamp FROM messages
-        WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?)
-        ORDER BY id ASC
-    """, (sender_user["name"], receiver_user["name"], receiver_user["name"], sender_user["name"]))
-    messages = [{"user": row[0], "text": row[1], "time": row[2]} for row in c.fetchall()]
-    conn.close()
-    return messages
+    try:
+        c.execute("SELECT COALESCE(MAX(id), 0) FROM messages WHERE receiver=? AND sender=?",
+                  (reader_name, peer_name))
+        return c.fetchone()[0]
+    finally:
+        conn.close()
 
-# -------------------- Unread API --------------------
-@app.get("/api/unread/{user_id}")
-async def api_get_unread(user_id: str):
-    """Return mapping sender_id -> count of unread messages for user_id"""
-    user = get_user_by_id(user_id)
-    if not user:
-        return JSONResponse({}, status_code=404)
+@traced
+def advance_read_cursor(reader_name: str, peer_name: str, seen_id: int):
+    """Move reader's cursor for peer to the newest message from peer with id <= seen_id
+    (single upsert; never moves backwards). Returns the resulting last_read_id"""
+    conn = db_connect(direct_messages_db(reader_name, peer_name))
+    c = conn.cursor()
+    try:
+        c.execute("""
+            INSERT INTO read_cursors (reader, peer, last_read_id)
+            SELECT ?, ?, COALESCE(MAX(id), 0) FROM messages
+            WHERE receiver=? AND sender=? AND id <= ?
+            ON CONFLICT(reader, peer) DO UPDATE
+            SET last_read_id = MAX(last_read_id, excluded.last_read_id)
+        """, (reader_name, peer_name, reader_name, peer_name, seen_id))
+        conn.commit()
+        bump_version("unread", reader_name)
+        c.execute("SELECT last_read_id FROM read_cursors WHERE reader=? AND peer=?",
+                  (reader_name, peer_name))
+        row = c.fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
 
-    conn = sqlite3.connect(CHAT_DB)
+async def send_to_global(user_id: str, payload: dict):
+    """Send payload to every global WS of the user; True if any device got it"""
+    return await send_to_connections(registry.global_for(user_id), payload) > 0
+
+async def flush_mark_read(user_id: str, target_id: str, user_name: str, target_name: str):
+    """Persist read cursor up to the seen id and push read receipts over global sockets"""
+    seen_id = pending_read_ids.pop((user_id, target_id), 0)
+    last_read_id = advance_read_cursor(user_name, target_name, seen_id)
+    # reader's UI clears the unread badge
+    await send_to_global(user_id, {"type": "unread_reset", "from_id": target_id,
+                                   "last_read_id": last_read_id})
+    # sender gets a read receipt
+    await send_to_global(target_id, {"type": "read", "by_id": user_id,
+                                     "last_read_id": last_read_id})
+
+async def _debounced_mark_read(key, user_name: str, target_name: str):
+    await asyncio.sleep(MARK_READ_DEBOUNCE)
+    pending_mark_reads.pop(key, None)
+    await flush_mark_read(key[0], key[1], user_name, target_name)
+
+def schedule_mark_read(user: dict, target: dict, seen_id: int = None):
+    """Coalesce mark_read calls per (user, target) into one delayed cursor update.
+    seen_id is the newest message the client has shown; without it, the newest one now.
+    Messages arriving before the flush stay unread unless a later call covers them"""
+    key = (user["id"], target["id"])
+    if seen_id is None:
+        seen_id = latest_message_id(user["name"], target["name"])
+    pending_read_ids[key] = max(pending_read_ids.get(key, 0), seen_id)
+    if key in pending_mark_reads:
+        return
+    task = asyncio.create_task(_debounced_mark_read(key, user["name"], target["name"]))
+    pending_mark_reads[key] = (task, user["name"], target["name"])
+
+async def flush_pending_mark_reads():
+    """Write out all debounced mark_read calls immediately"""
+    for key, (task, user_name, target_name) in list(pending_mark_reads.items()):
+        task.cancel()
+        pending_mark_reads.pop(key, None)
+        try:
+            await flush_mark_read(key[0], key[1], user_name, target_name)
+        except Exception as e:
+            print(f"[ERROR] flushing mark_read {key}: {e}")
+
+# -------------------- Offline notifications --------------------
+PENDING_PER_USER = int(os.environ.get("MYCHAT_PENDING_PER_USER", "200"))  # oldest dropped beyond this
+PENDING_IN_MEMORY = int(os.environ.get("MYCHAT_PENDING_IN_MEMORY", "10000"))  # all users; LRU queues spill to disk
+pending_notifications = OrderedDict()  # {user_id: deque of notify payloads}, least recently queued first
+pending_in_memory = 0
+spilled_users = set()  # users with rows in the pending_notifications table
+
+def queue_notification(user_id: str, payload: dict):
+    """Hold a notification for a user with no global socket until they connect"""
+    global pending_in_memory
+    queue = pending_notifications.get(user_id)
+    if queue is None:
+        queue = pending_notifications[user_id] = deque()
+    else:
+        pending_notifications.move_to_end(user_id)
+    queue.append(payload)
+    pending_in_memory += 1
+    metrics["notifications_queued"] += 1
+    if len(queue) > PENDING_PER_USER:
+        queue.popleft()
+        pending_in_memory -= 1
+        metrics["notifications_dropped"] += 1
+    while pending_in_memory > PENDING_IN_MEMORY and pending_notifications:
+        spilled_id, spilled = pending_notifications.popitem(last=False)
+        pending_in_memory -= len(spilled)
+        spill_notifications(spilled_id, spilled)
+
+@traced
+def spill_notifications(user_id: str, payloads):
+    """Move a user's queued notifications to disk, keeping the newest PENDING_PER_USER"""
+    conn = db_connect(CHAT_DB)
     c = conn.cursor()
-    # group by sender name
-    c.execute("""
-        SELECT sender, COUNT(*) FROM messages
-        WHERE receiver=? AND read=0
-        GROUP BY sender
-    """, (user["name"],))
-    rows = c.fetchall()
-    conn.close()
+    try:
+        c.executemany("INSERT INTO pending_notifications (user_id, payload) VALUES (?, ?)",
+                      [(user_id, dumps(p).decode("utf-8")) for p in payloads])
+        c.execute("""
+            DELETE FROM pending_notifications
+            WHERE user_id=? AND id NOT IN (
+                SELECT id FROM pending_notifications WHERE user_id=? ORDER BY id DESC LIMIT ?
+            )
+        """, (user_id, user_id, PENDING_PER_USER))
+        conn.commit()
+        spilled_users.add(user_id)
+        metrics["notifications_spilled"] += len(payloads)
+    finally:
+        conn.close()
+
+@traced
+def take_pending_notifications(user_id: str):
+    """Remove and return everything queued for a user, oldest first"""
+    global pending_in_memory
+    taken = []
+    if user_id in spilled_users:
+        conn = db_connect(CHAT_DB)
+        c = conn.cursor()
+        try:
+            c.execute("SELECT payload FROM pending_notifications WHERE user_id=? ORDER BY id",
+                      (user_id,))
+            taken = [json.loads(row[0]) for row in c.fetchall()]
+            c.execute("DELETE FROM pending_notifications WHERE user_id=?", (user_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        spilled_users.discard(user_id)
+    queue = pending_notifications.pop(user_id, None)
+    if queue:
+        pending_in_memory -= len(queue)
+        taken.extend(queue)
+    return taken[-PENDING_PER_USER:]
+
+def load_spilled_users():
+    """Users with notifications left on disk by an earlier run"""
+    conn = db_connect(CHAT_DB)
+    c = conn.cursor()
+    try:
+        c.execute("SELECT DISTINCT user_id FROM pending_notifications")
+        spilled_users.update(row[0] for row in c.fetchall())
+    finally:
+        conn.close()
+
+def flush_pending_notifications():
+    """Spill every in-memory queue to disk (shutdown)"""
+    global pending_in_memory
+    while pending_notifications:
+        user_id, queue = pending_notifications.popitem(last=False)
+        pending_in_memory -= len(queue)
+        try:
+            spill_notifications(user_id, queue)
+        except Exception as e:
+            print(f"[ERROR] spilling notifications for {user_id}: {e}")
+
+def merge_notifications(*batches):
+    """Merge notification lists, dropping duplicates, ordered by ts"""
+    merged = {}
+    for batch in batches:
+        for n in batch:
+            merged[(n.get("from_id"), n.get("id"), n.get("ts"))] = n
+    return sorted(merged.values(), key=lambda n: n.get("ts") or "")
+
+# -------------------- Unread API --------------------
+@traced
+def get_unread_counts(user: dict):
+    """Mapping sender_id -> count of unread messages for user"""
+    rows = []
+    # a conversation and its cursors share a shard, so per-shard counts just add up
+    for path in direct_message_dbs():
+        conn = db_connect(path)
+        c = conn.cursor()
+        # group by sender name; everything past the reader's cursor is unread
+        c.execute("""
+            SELECT m.sender, COUNT(*) FROM messages m
+            LEFT JOIN read_cursors rc ON rc.reader = m.receiver AND rc.peer = m.sender
+            WHERE m.receiver=? AND m.id > COALESCE(rc.last_read_id, 0)
+            GROUP BY m.sender
+        """, (user["name"],))
+        rows.extend(c.fetchall())
+        conn.close()
 
     # map sender names to IDs
     result = {}
@@ -525,37 +2005,34 @@ async def api_get_unread(user_id: str):
             result[sender_name] = cnt
     return result
 
+@app.get("/api/unread/{user_id}")
+async def api_get_unread(request: Request, user_id: str):
+    """Return mapping sender_id -> count of unread messages for user_id"""
+    user = get_user_by_id(user_id)
+    if not user:
+        return JSONResponse({}, status_code=404)
+
+    etag = make_etag("unread", user_id, get_version("unread", user["name"]), get_version("users"))
+    return cached_json_response(request, etag, lambda: get_unread_counts(user))
+
 @app.post("/api/mark_read/{user_id}/{target_id}")
-async def api_mark_read(user_id: str, target_id: str):
-    """Mark as read messages where sender=target and receiver=user"""
+async def api_mark_read(request: Request, user_id: str, target_id: str):
+    """Mark as read messages where sender=target and receiver=user, up to ?last_id= (the newest
+    message the client has shown). The cursor update is debounced; 'unread_reset' and 'read'
+    events follow over global WS"""
     user = get_user_by_id(user_id)
     target = get_user_by_id(target_id)
     if not user or not target:
         return JSONResponse({"status":"error"}, status_code=404)
 
-    conn = sqlite3.connect(CHAT_DB)
-    c = conn.cursor()
-    c.execute("""
-        UPDATE messages SET read=1
-        WHERE sender=? AND receiver=? AND read=0
-    """, (target["name"], user["name"]))
-    conn.commit()
-    conn.close()
-
-    # also notify client UI (optional) — send updated unread map to user's global WS if connected
-    if user_id in global_connections:
-        try:
-            # send small 'unread_reset' event
-            await global_connections[user_id].send_json({"type":"unread_reset","from_id": target_id})
-        except Exception:
-            pass
-
+    schedule_mark_read(user, target, parse_int_param(request.query_params.get("last_id")))
     return {"status": "ok"}
 
 # -------------------- Rooms Management --------------------
+@traced
 def create_room(room_id: str, name: str, description: str, creator_id: str):
     """Create a new room"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         created_at = datetime.now().isoformat()
@@ -569,12 +2046,14 @@ def create_room(room_id: str, name: str, description: str, creator_id: str):
             VALUES (?, ?, ?)
         """, (room_id, creator_id, created_at))
         conn.commit()
+        bump_version("rooms")
     finally:
         conn.close()
 
+@traced
 def delete_room(room_id: str, user_id: str):
     """Delete a room (only by creator)"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         # Check if user is creator
@@ -585,13 +2064,25 @@ def delete_room(room_id: str, user_id: str):
         # Delete room (cascade will delete members and messages)
         c.execute("DELETE FROM rooms WHERE id=?", (room_id,))
         conn.commit()
+        if MESSAGE_SHARDS:
+            # no cascade across files
+            shard = db_connect(room_messages_db(room_id))
+            try:
+                shard.execute("DELETE FROM room_messages WHERE room_id=?", (room_id,))
+                shard.commit()
+            finally:
+                shard.close()
+        recent_messages.discard(("room", room_id))
+        bump_version("rooms")
+        bump_version("members", room_id)
         return True
     finally:
         conn.close()
 
+@traced
 def get_room(room_id: str):
     """Get room info"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         c.execute("""
@@ -611,39 +2102,39 @@ def get_room(room_id: str):
         conn.close()
     return None
 
+@traced
 def get_user_rooms(user_id: str):
     """Get all rooms user is a member of"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         c.execute("""
             SELECT r.id, r.name, r.description, r.creator_id, r.created_at,
-                   COUNT(rm.user_id) as member_count
+                   (SELECT COUNT(*) FROM room_members m WHERE m.room_id = r.id) as member_count
             FROM rooms r
             INNER JOIN room_members rm ON r.id = rm.room_id
             WHERE rm.user_id = ?
-            GROUP BY r.id
             ORDER BY r.created_at DESC
         """, (user_id,))
-        rooms = []
-        for row in c.fetchall():
-            creator = get_user_by_id(row[3])
-            rooms.append({
-                "id": row[0],
-                "name": row[1],
-                "description": row[2],
-                "creator_id": row[3],
-                "creator_name": creator["name"] if creator else "Unknown",
-                "member_count": row[5],
-                "created_at": row[4]
-            })
+        rows = c.fetchall()
     finally:
         conn.close()
-    return rooms
-
+    # one lookup for all creators instead of one per room
+    creator_names = {u["id"]: u["name"] for u in get_users_by_ids([row[3] for row in rows])}
+    return [{
+        "id": row[0],
+        "name": row[1],
+        "description": row[2],
+        "creator_id": row[3],
+        "creator_name": creator_names.get(row[3], "Unknown"),
+        "member_count": row[5],
+        "created_at": row[4]
+    } for row in rows]
+
+@traced
 def add_user_to_room(room_id: str, user_id: str, adder_id: str):
     """Add user to room (only by creator)"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         # Check if adder is creator
@@ -662,13 +2153,16 @@ def add_user_to_room(room_id: str, user_id: str, adder_id: str):
             VALUES (?, ?, ?)
         """, (room_id, user_id, added_at))
         conn.commit()
+        bump_version("rooms")
+        bump_version("members", room_id)
         return True
     finally:
         conn.close()
 
+@traced
 def remove_user_from_room(room_id: str, user_id: str, remover_id: str):
     """Remove user from room (only by creator, can't remove creator)"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         # Check if remover is creator
@@ -682,32 +2176,88 @@ def remove_user_from_room(room_id: str, user_id: str, remover_id: str):
         # Remove user
         c.execute("DELETE FROM room_members WHERE room_id=? AND user_id=?", (room_id, user_id))
         conn.commit()
+        bump_version("rooms")
+        bump_version("members", room_id)
         return True
     finally:
         conn.close()
 
+@traced
+def add_users_to_room(room_id: str, user_ids: list, adder_id: str):
+    """Add many users to room in one transaction (only by creator).
+    Returns list of newly added user ids, or None if not authorized"""
+    conn = db_connect(ROOMS_DB)
+    c = conn.cursor()
+    try:
+        # Check if adder is creator
+        c.execute("SELECT creator_id FROM rooms WHERE id=?", (room_id,))
+        row = c.fetchone()
+        if not row or row[0] != adder_id:
+            return None
+        # Skip unknown users and users that are already members
+        known_ids = {u["id"] for u in get_users_by_ids(user_ids)}
+        c.execute("SELECT user_id FROM room_members WHERE room_id=?", (room_id,))
+        current_ids = {r[0] for r in c.fetchall()}
+        added = [uid for uid in dict.fromkeys(user_ids)
+                 if uid in known_ids and uid not in current_ids]
+        if added:
+            added_at = datetime.now().isoformat()
+            c.executemany("""
+                INSERT OR IGNORE INTO room_members (room_id, user_id, added_at)
+                VALUES (?, ?, ?)
+            """, [(room_id, uid, added_at) for uid in added])
+            conn.commit()
+            bump_version("rooms")
+            bump_version("members", room_id)
+        return added
+    finally:
+        conn.close()
+
+@traced
+def remove_users_from_room(room_id: str, user_ids: list, remover_id: str):
+    """Remove many users from room in one transaction (only by creator, creator is kept).
+    Returns list of removed user ids, or None if not authorized"""
+    conn = db_connect(ROOMS_DB)
+    c = conn.cursor()
+    try:
+        # Check if remover is creator
+        c.execute("SELECT creator_id FROM rooms WHERE id=?", (room_id,))
+        row = c.fetchone()
+        if not row or row[0] != remover_id:
+            return None
+        c.execute("SELECT user_id FROM room_members WHERE room_id=?", (room_id,))
+        current_ids = {r[0] for r in c.fetchall()}
+        removed = [uid for uid in dict.fromkeys(user_ids)
+                   if uid in current_ids and uid != row[0]]
+        if removed:
+            c.executemany("DELETE FROM room_members WHERE room_id=? AND user_id=?",
+                          [(room_id, uid) for uid in removed])
+            conn.commit()
+            bump_version("rooms")
+            bump_version("members", room_id)
+        return removed
+    finally:
+        conn.close()
+
+@traced
 def get_room_members(room_id: str):
     """Get all members of a room"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         c.execute("""
             SELECT user_id FROM room_members WHERE room_id = ?
         """, (room_id,))
         member_ids = [row[0] for row in c.fetchall()]
-        # Get user names from users database
-        members = []
-        for user_id in member_ids:
-            user = get_user_by_id(user_id)
-            if user:
-                members.append({"id": user_id, "name": user["name"]})
     finally:
         conn.close()
-    return members
+    # Get user names from users database in one query
+    return get_users_by_ids(member_ids)
 
+@traced
 def is_room_member(room_id: str, user_id: str):
     """Check if user is member of room"""
-    conn = sqlite3.connect(ROOMS_DB)
+    conn = db_connect(ROOMS_DB)
     c = conn.cursor()
     try:
         c.execute("SELECT 1 FROM room_members WHERE room_id=? AND user_id=?", (room_id, user_id))
@@ -715,14 +2265,15 @@ def is_room_member(room_id: str, user_id: str):
     finally:
         conn.close()
 
+@traced
 def save_room_message(room_id: str, sender_id: str, sender_name: str, text: str,
                      reply_to_sender_id: str = None, reply_to_sender_name: str = None,
                      reply_to_text: str = None):
-    """Save message to room"""
-    conn = sqlite3.connect(ROOMS_DB)
+    """Save message to room, returns (id, timestamp)"""
+    conn = db_connect(room_messages_db(room_id))
     c = conn.cursor()
     try:
-        timestamp = datetime.now().strftime("%H:%M")
+        timestamp = now_timestamp()
         c.execute("""
             INSERT INTO room_messages (room_id, sender_id, sender_name, text, timestamp,
                                      reply_to_sender_id, reply_to_sender_name, reply_to_text)
@@ -730,41 +2281,96 @@ def save_room_message(room_id: str, sender_id: str, sender_name: str, text: str,
         """, (room_id, sender_id, sender_name, text, timestamp,
               reply_to_sender_id, reply_to_sender_name, reply_to_text))
         conn.commit()
+        bump_version("room_messages", room_id)
+        return c.lastrowid, timestamp
     finally:
         conn.close()
 
-def get_room_history(room_id: str):
-    """Get room message history"""
-    conn = sqlite3.connect(ROOMS_DB)
+@traced
+def get_room_history(room_id: str, since_id: int = 0, limit: int = None):
+    """Get room message history with id > since_id, oldest first"""
+    conn = db_connect(room_messages_db(room_id))
     c = conn.cursor()
     try:
         c.execute("""
             SELECT sender_name, text, timestamp, sender_id,
-                   reply_to_sender_id, reply_to_sender_name, reply_to_text
+                   reply_to_sender_id, reply_to_sender_name, reply_to_text, id
             FROM room_messages
-            WHERE room_id = ?
+            WHERE room_id = ? AND id > ?
+            ORDER BY id ASC
+            LIMIT ?
+        """, (room_id, since_id, -1 if limit is None else limit))
+        return [room_message_from_row(room_id, row) for row in c.fetchall()]
+    finally:
+        conn.close()
+
+@traced
+def get_room_history_json(room_id: str):
+    """Full room history as JSON array bytes, rows encoded by SQLite (no per-row dicts)"""
+    conn = db_connect(room_messages_db(room_id))
+    c = conn.cursor()
+    try:
+        c.execute(f"""
+            SELECT CASE WHEN COALESCE(reply_to_sender_id, '') != ''
+                        THEN json_set(msg, '$.reply_to', json_object(
+                            'sender_id', reply_to_sender_id,
+                            'sender_name', reply_to_sender_name,
+                            'text', reply_to_text))
+                        ELSE msg END
+            FROM (
+                SELECT id, reply_to_sender_id, reply_to_sender_name, reply_to_text,
+                       json_object('id', id, 'user', sender_name, 'text', text,
+                                   'time', {DISPLAY_TIME_SQL}, 'ts', timestamp,
+                                   'sender_id', sender_id, 'room_id', room_id) AS msg
+                FROM room_messages
+                WHERE room_id = ?
+            )
             ORDER BY id ASC
         """, (room_id,))
-        messages = []
-        for row in c.fetchall():
-            msg = {
-                "user": row[0],
-                "text": row[1],
-                "time": row[2],
-                "sender_id": row[3]
-            }
-            if row[4]:  # reply_to_sender_id
-                msg["reply_to"] = {
-                    "sender_id": row[4],
-                    "sender_name": row[5],
-                    "text": row[6]
-                }
-            messages.append(msg)
+        return json_array(row[0].encode("utf-8") for row in c.fetchall())
     finally:
         conn.close()
-    return messages
+
+@traced
+def get_room_history_page(room_id: str, limit: int, before: int = None):
+    """Newest `limit` room messages with id < before, oldest first"""
+    conn = db_connect(room_messages_db(room_id))
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT sender_name, text, timestamp, sender_id,
+                   reply_to_sender_id, reply_to_sender_name, reply_to_text, id
+            FROM room_messages
+            WHERE room_id = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """, (room_id, MAX_ROW_ID if before is None else before, limit))
+        rows = c.fetchall()
+    finally:
+        conn.close()
+    return [room_message_from_row(room_id, row) for row in reversed(rows)]
+
+def room_message_from_row(room_id: str, row):
+    msg = {
+        "id": row[7],
+        "user": row[0],
+        "text": row[1],
+        "time": display_time(row[2]),
+        "ts": row[2],
+        "sender_id": row[3],
+        "room_id": room_id
+    }
+    if row[4]:  # reply_to_sender_id
+        msg["reply_to"] = {
+            "sender_id": row[4],
+            "sender_name": row[5],
+            "text": row[6]
+        }
+    return msg
 
 # -------------------- Rooms API --------------------
+MAX_BULK_MEMBERS = 1000  # upper bound for add_users / remove_users payloads
+
 @app.post("/api/rooms/create")
 async def api_create_room(request: Request):
     """Create a new room"""
@@ -811,8 +2417,9 @@ async def api_get_rooms(request: Request):
     if not user_id:
         return JSONResponse({"error": "Not authenticated"}, status_code=401)
     
-    rooms = get_user_rooms(user_id)
-    return rooms
+    etag = make_etag("rooms", user_id, get_version("rooms"))
+    return cached_json_response(request, etag, lambda: get_user_rooms(user_id),
+                                cache_key=("rooms", user_id))
 
 @app.post("/api/rooms/{room_id}/add_user")
 async def api_add_user_to_room(request: Request, room_id: str):
@@ -848,6 +2455,54 @@ async def api_remove_user_from_room(request: Request, room_id: str):
         return {"status": "ok"}
     return JSONResponse({"error": "Not authorized"}, status_code=403)
 
+@app.post("/api/rooms/{room_id}/add_users")
+async def api_add_users_to_room(request: Request, room_id: str):
+    """Add many users to room in one transaction"""
+    user_id = request.cookies.get("user_id")
+    if not user_id:
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    
+    data = await request.json()
+    target_user_ids = data.get("user_ids")
+    
+    if not isinstance(target_user_ids, list) or not target_user_ids:
+        return JSONResponse({"error": "user_ids required"}, status_code=400)
+    if len(target_user_ids) > MAX_BULK_MEMBERS:
+        return JSONResponse({"error": f"At most {MAX_BULK_MEMBERS} users per request"}, status_code=400)
+    
+    added = add_users_to_room(room_id, [str(uid) for uid in target_user_ids], user_id)
+    if added is None:
+        return JSONResponse({"error": "Not authorized"}, status_code=403)
+    
+    members = get_room_members(room_id)
+    if added:
+        await broadcast_room_members(room_id, members, added=added, removed=[])
+    return {"status": "ok", "added": added, "members": members}
+
+@app.post("/api/rooms/{room_id}/remove_users")
+async def api_remove_users_from_room(request: Request, room_id: str):
+    """Remove many users from room in one transaction"""
+    user_id = request.cookies.get("user_id")
+    if not user_id:
+        return JSONResponse({"error": "Not authenticated"}, status_code=401)
+    
+    data = await request.json()
+    target_user_ids = data.get("user_ids")
+    
+    if not isinstance(target_user_ids, list) or not target_user_ids:
+        return JSONResponse({"error": "user_ids required"}, status_code=400)
+    if len(target_user_ids) > MAX_BULK_MEMBERS:
+        return JSONResponse({"error": f"At most {MAX_BULK_MEMBERS} users per request"}, status_code=400)
+    
+    removed = remove_users_from_room(room_id, [str(uid) for uid in target_user_ids], user_id)
+    if removed is None:
+        return JSONResponse({"error": "Not authorized"}, status_code=403)
+    
+    members = get_room_members(room_id)
+    if removed:
+        await broadcast_room_members(room_id, members, added=[], removed=removed)
+    return {"status": "ok", "removed": removed, "members": members}
+
 @app.get("/api/rooms/{room_id}/members")
 async def api_get_room_members(request: Request, room_id: str):
     """Get room members"""
@@ -858,8 +2513,8 @@ async def api_get_room_members(request: Request, room_id: str):
     if not is_room_member(room_id, user_id):
         return JSONResponse({"error": "Not a member"}, status_code=403)
     
-    members = get_room_members(room_id)
-    return members
+    etag = make_etag("members", room_id, get_version("members", room_id))
+    return cached_json_response(request, etag, lambda: get_room_members(room_id))
 
 @app.get("/api/rooms/{room_id}/history")
 async def api_get_room_history(request: Request, room_id: str):
@@ -871,13 +2526,41 @@ async def api_get_room_history(request: Request, room_id: str):
     if not is_room_member(room_id, user_id):
         return JSONResponse({"error": "Not a member"}, status_code=403)
     
-    messages = get_room_history(room_id)
-    return messages
+    limit, before = parse_history_page(request)
+    etag = make_etag("room_history", room_id, get_version("room_messages", room_id), limit, before)
+    if limit is None:
+        return cached_json_response(request, etag, lambda: get_room_history_json(room_id))
+    return cached_json_response(request, etag, lambda: recent_page(
+        ("room", room_id), limit, before,
+        lambda limit, before: get_room_history_page(room_id, limit, before)))
 
 # -------------------- Room WebSocket --------------------
+async def broadcast_to_room(room_id: str, payload: dict):
+    """Send payload to every connected member of a room, dropping dead sockets"""
+    await send_to_connections(registry.room(room_id), payload)
+
+async def broadcast_room_members(room_id: str, members: list, added: list, removed: list):
+    """Emit one membership-change event to room sockets and disconnect removed members"""
+    await broadcast_to_room(room_id, {
+        "type": "members",
+        "room_id": room_id,
+        "added": added,
+        "removed": removed,
+        "members": members
+    })
+    for member_id in removed:
+        for conn in registry.room_member(room_id, member_id):
+            registry.remove(conn)
+            try:
+                await conn.websocket.close(code=1008, reason="Removed from room")
+            except Exception:
+                pass
+
 @app.websocket("/ws/room/{room_id}/{user_id}")
 async def room_websocket_endpoint(websocket: WebSocket, room_id: str, user_id: str):
     """WebSocket endpoint for room chat"""
+    if await refuse_if_shutting_down(websocket):
+        return
     await websocket.accept()
     
     # Check if user is member
@@ -885,97 +2568,100 @@ async def room_websocket_endpoint(websocket: WebSocket, room_id: str, user_id: s
         await websocket.close(code=1008, reason="Not a member")
         return
     
+    # Resume: collect messages missed since the client's last seen id before
+    # registering, so anything saved afterwards is delivered live
+    since_id = parse_int_param(websocket.query_params.get("since"))
+    replay = recent_since(("room", room_id), since_id,
+                          lambda since, limit: get_room_history(room_id, since, limit)) \
+        if since_id is not None else None
+    
     # Add to room connections
-    if room_id not in room_connections:
-        room_connections[room_id] = {}
-    room_connections[room_id][user_id] = websocket
+    conn = registry.add(websocket, "room", user_id, room_id=room_id)
     
     sender_info = get_user_by_id(user_id)
     sender_name = sender_info["name"] if sender_info else user_id
     
     print(f"[ROOM WS CONNECT] {user_id} -> room {room_id}")
+    if replay:
+        await send_frame(websocket, dict(replay, room_id=room_id))
     
     try:
         while True:
             data = await websocket.receive_text()
-            print(f"[ROOM WS RECV] from {user_id} in room {room_id}: {data}")
-            
-            # Parse message data (could be JSON with reply info)
-            text = data
-            reply_to = None
-            try:
-                msg_data = json.loads(data)
-                # Check if it's actually a JSON object with our structure
-                if isinstance(msg_data, dict) and "text" in msg_data:
-                    text = msg_data.get("text", data)
-                    reply_to = msg_data.get("reply_to")
-                else:
-                    # JSON but not our format - treat as plain text
-                    text = data
-                    reply_to = None
-            except (json.JSONDecodeError, ValueError, TypeError, AttributeError):
-                # Plain text message - use data as-is
+            with handler_trace(f"WS /ws/room/{room_id}"):
+                print(f"[ROOM WS RECV] from {user_id} in room {room_id}: {data}")
+
+                # Cheap guard before parsing: text + quoted text + JSON envelope
+                if len(data) > 2 * MAX_MESSAGE_LENGTH + 1024:
+                    await reject_too_long(websocket)
+                    continue
+
+                # Parse message data (could be JSON with reply info)
                 text = data
                 reply_to = None
-            
-            timestamp = datetime.now().strftime("%H:%M")
-            
-            # Extract reply information
-            reply_to_sender_id = None
-            reply_to_sender_name = None
-            reply_to_text = None
-            
-            if reply_to:
-                reply_to_sender_id = reply_to.get("sender_id")
-                reply_to_sender_name = reply_to.get("sender_name")
-                reply_to_text = reply_to.get("text")
-            
-            # Save message to database
-            save_room_message(room_id, user_id, sender_name, text,
-                            reply_to_sender_id, reply_to_sender_name, reply_to_text)
-            
-            # Prepare message data with sender info
-            message_data = {
-                "user": sender_name,
-                "text": text,
-                "time": timestamp,
-                "sender_id": user_id,
-                "room_id": room_id
-            }
-            
-            # Add reply info if present
-            if reply_to:
-                message_data["reply_to"] = {
-                    "sender_id": reply_to_sender_id,
-                    "sender_name": reply_to_sender_name,
-                    "text": reply_to_text
-                }
-            
-            # Broadcast to all room members
-            for member_id, ws in list(room_connections[room_id].items()):
                 try:
-                    await ws.send_json(message_data)
-                except Exception as e:
-                    print(f"[WARN] send to room member {member_id} failed: {e}")
-                    # Remove dead connection
-                    try:
-                        del room_connections[room_id][member_id]
-                    except Exception:
-                        pass
-            
-            # If room is empty, remove it
-            if not room_connections[room_id]:
-                del room_connections[room_id]
+                    msg_data = json.loads(data)
+                    # Check if it's actually a JSON object with our structure
+                    if isinstance(msg_data, dict) and "text" in msg_data:
+                        text = msg_data.get("text", data)
+                        reply_to = msg_data.get("reply_to")
+                    else:
+                        # JSON but not our format - treat as plain text
+                        text = data
+                        reply_to = None
+                except (json.JSONDecodeError, ValueError, TypeError, AttributeError):
+                    # Plain text message - use data as-is
+                    text = data
+                    reply_to = None
+                if not isinstance(text, str):
+                    text = str(text)
+
+                if not await check_incoming_message(websocket, text, user_id, room_id):
+                    continue
+
+                # Extract reply information
+                reply_to_sender_id = None
+                reply_to_sender_name = None
+                reply_to_text = None
+
+                if reply_to:
+                    reply_to_sender_id = reply_to.get("sender_id")
+                    reply_to_sender_name = reply_to.get("sender_name")
+                    reply_to_text = reply_to.get("text")
+                    # Quotes are previews; don't let them bypass the size cap
+                    if isinstance(reply_to_text, str):
+                        reply_to_text = reply_to_text[:MAX_MESSAGE_LENGTH]
+
+                # Save message to database
+                message_id, timestamp = save_room_message(room_id, user_id, sender_name, text,
+                                                          reply_to_sender_id, reply_to_sender_name, reply_to_text)
+
+                # Prepare message data with sender info
+                message_data = {
+                    "id": message_id,
+                    "user": sender_name,
+                    "text": text,
+                    "time": display_time(timestamp),
+                    "ts": timestamp,
+                    "sender_id": user_id,
+                    "room_id": room_id
+                }
+
+                # Add reply info if present
+                if reply_to:
+                    message_data["reply_to"] = {
+                        "sender_id": reply_to_sender_id,
+                        "sender_name": reply_to_sender_name,
+                        "text": reply_to_text
+                    }
+
+                recent_messages.append(("room", room_id), message_data)
+                # Broadcast to all room members
+                await broadcast_to_room(room_id, message_data)
     
     except WebSocketDisconnect:
         print(f"[ROOM WS DISCONNECT] {user_id} -> room {room_id}")
-        try:
-            if room_id in room_connections and user_id in room_connections[room_id]:
-                del room_connections[room_id][user_id]
-                if not room_connections[room_id]:
-                    del room_connections[room_id]
-        except Exception as e:
-            print(f"[ERROR] cleaning room connections after disconnect: {e}")
+        registry.remove(conn)
         try:
             await websocket.close()
         except Exception:
@@ -983,13 +2669,7 @@ async def room_websocket_endpoint(websocket: WebSocket, room_id: str, user_id: s
         await asyncio.sleep(0.1)
     except Exception as exc:
         print(f"[ERROR] room_websocket_endpoint exception {user_id}->room {room_id}: {exc}")
-        try:
-            if room_id in room_connections and user_id in room_connections[room_id]:
-                del room_connections[room_id][user_id]
-                if not room_connections[room_id]:
-                    del room_connections[room_id]
-        except Exception as e:
-            print(f"[ERROR] cleanup after exception: {e}")
+        registry.remove(conn)
         try:
             await websocket.close()
         except Exception:
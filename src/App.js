@@ -12,15 +12,30 @@ const App = () => {
   const username = localStorage.getItem("username") || "User1";
   const userId = localStorage.getItem("user_id") || "user-uuid-1";
 
-  // WebSocket для статусов пользователей
+  // WebSocket для статусов контактов: один снимок "contacts", затем изменения "presence"
   useEffect(() => {
     const wsProtocol = window.location.protocol === "https:" ? "wss" : "ws";
     const wsStatus = new WebSocket(`${wsProtocol}://${window.location.host}/ws/status`);
 
     wsStatus.onmessage = (event) => {
-      const allUsers = JSON.parse(event.data);
-      setUsers(allUsers.filter(u => u.id !== userId));
+      const data = JSON.parse(event.data);
+      if (data.type === "contacts") {
+        setUsers(data.users.filter(u => u.id !== userId));
+      } else if (data.type === "presence") {
+        setUsers(prev => {
+          const next = prev.slice();
+          for (const p of data.users) {
+            if (p.id === userId) continue;
+            const i = next.findIndex(u => u.id === p.id);
+            if (i >= 0) next[i] = { ...next[i], online: p.online };
+            else next.push(p);
+          }
+          return next;
+        });
+      }
     };
+
+    return () => wsStatus.close();
   }, [userId]);
 
   // WebSocket для чата с выбранным пользователем
@@ -27,12 +27,38 @@ document.addEventListener("DOMContentLoaded", () => {
   let wsStatus = null;
   let wsGlobal = null;
   const unread = {};
+  // Resume cursors: last seen message id per chat/room, last seen notify ts
+  const lastChatIds = {};
+  const lastRoomIds = {};
+  let lastNotifyTs = null;
+  // Read receipts: newest of my messages each peer has read (from "read" events)
+  const peerReadIds = {};
+  
+  // History paging: first page on open, older pages when scrolled to the top
+  const HISTORY_PAGE = 50;
+  let oldestLoadedId = null; // null once the start of the history is reached
+  let loadingOlder = false;
   
   // Reply functionality for rooms only
   let replyToMessage = null; // {sender_id, sender_name, text}
 
   const wsProtocol = location.protocol === "https:" ? "wss" : "ws";
 
+  // Reconnect delay: server hint from a "reconnect" frame (graceful shutdown),
+  // otherwise base plus jitter so clients don't reconnect in lockstep
+  let reconnectHintMs = null;
+  function reconnectDelay(base) {
+    if (reconnectHintMs !== null) return reconnectHintMs;
+    return base + Math.floor(Math.random() * base);
+  }
+  function isReconnectHint(msg) {
+    if (msg && msg.type === "reconnect") {
+      reconnectHintMs = msg.retry_after_ms || null;
+      return true;
+    }
+    return false;
+  }
+
   // helper: get cookie
   function getCookie(name) {
     const m = document.cookie.match("(^|;) ?"+name+"=([^;]*)(;|$)");
@@ -46,38 +72,80 @@ document.addEventListener("DOMContentLoaded", () => {
     try {
       const res = await fetch(`/api/unread/${myId}`);
       if (!res.ok) return;
-      const data = await res.json();
-      // Only update unread counts from API, don't reset to 0 for all users
-      // This ensures we only show actual unread messages
-      for (const sid in data) {
-        unread[sid] = parseInt(data[sid]) || 0;
-      }
-      // Only set to 0 for users that are in the API response but have 0 unread
-      // Don't reset users that aren't in the response (they might have unread we haven't loaded yet)
-      for (const u of allUsers) {
-        if (u.id in data && data[u.id] === 0) {
-          unread[u.id] = 0;
-        } else if (!(u.id in data)) {
-          // Keep existing unread count if not in API response
-          if (!(u.id in unread)) {
-            unread[u.id] = 0;
-          }
-        }
-      }
-      renderUsers();
+      applyUnreadCounts(await res.json());
       console.log("[unread] loaded from DB", unread);
     } catch (err) {
       console.warn("Ошибка получения непрочитанных:", err);
     }
   }
 
+  // Unread counts from the server (API or the notify_batch frame on connect)
+  function applyUnreadCounts(data) {
+    // Only update unread counts from API, don't reset to 0 for all users
+    // This ensures we only show actual unread messages
+    for (const sid in data) {
+      unread[sid] = parseInt(data[sid]) || 0;
+    }
+    // Only set to 0 for users that are in the API response but have 0 unread
+    // Don't reset users that aren't in the response (they might have unread we haven't loaded yet)
+    for (const u of allUsers) {
+      if (u.id in data && data[u.id] === 0) {
+        unread[u.id] = 0;
+      } else if (!(u.id in data)) {
+        // Keep existing unread count if not in API response
+        if (!(u.id in unread)) {
+          unread[u.id] = 0;
+        }
+      }
+    }
+    renderUsers();
+  }
+
   // ---- STATUS WS ----
+  // Server sends my contacts (people sharing a room or chat with me) once as
+  // {type: "contacts"}, then {type: "presence"} updates for them and for any
+  // users subscribed with {type: "watch", ids}
+  function watchUsers(ids) {
+    if (ids.length && wsStatus && wsStatus.readyState === WebSocket.OPEN) {
+      wsStatus.send(JSON.stringify({ type: "watch", ids }));
+    }
+  }
+
+  // Add a user (e.g. from search or an incoming message) to the contact list
+  function ensureContact(id, name, online = false) {
+    let u = allUsers.find(x => x.id === id);
+    if (!u) {
+      u = { id, name, online };
+      allUsers.push(u);
+      if (!(id in unread)) unread[id] = 0;
+      watchUsers([id]);
+      renderUsers();
+    }
+    return u;
+  }
+
   function openStatusWS(){
     wsStatus = new WebSocket(`${wsProtocol}://${location.host}/ws/status`);
     wsStatus.onopen = () => console.log("[WS status] opened");
     wsStatus.onmessage = (e) => {
       try {
-        allUsers = JSON.parse(e.data);
+        const data = JSON.parse(e.data);
+        if (isReconnectHint(data)) return;
+        if (data.type === "contacts") {
+          // Keep users added locally (search results, new chats) and re-subscribe to them
+          const ids = new Set(data.users.map(u => u.id));
+          const extra = allUsers.filter(u => !ids.has(u.id));
+          allUsers = data.users.concat(extra);
+          watchUsers(extra.map(u => u.id));
+        } else if (data.type === "presence") {
+          for (const p of data.users || []) {
+            const u = allUsers.find(x => x.id === p.id);
+            if (u) u.online = p.online;
+            else allUsers.push(p);
+          }
+        } else {
+          return;
+        }
         for (const u of allUsers)
           if (!(u.id in unread)) unread[u.id] = 0;
         renderUsers();
@@ -87,7 +155,7 @@ document.addEventListener("DOMContentLoaded", () => {
     };
     wsStatus.onclose = () => {
       console.log("[WS status] closed, reconnecting...");
-      setTimeout(openStatusWS, 1500);
+      setTimeout(openStatusWS, reconnectDelay(1500));
     };
     wsStatus.onerror = (e) => console.warn("[WS status] error", e);
   }
@@ -102,28 +170,33 @@ document.addEventListener("DOMContentLoaded", () => {
       return;
     }
     try {
-      wsGlobal = new WebSocket(`${wsProtocol}://${location.host}/ws/global/${myId}`);
+      const since = lastNotifyTs ? `?since=${encodeURIComponent(lastNotifyTs)}` : "";
+      wsGlobal = new WebSocket(`${wsProtocol}://${location.host}/ws/global/${myId}${since}`);
     } catch (e) {
       console.warn("Не удалось открыть global WS", e);
       setTimeout(openGlobalWS, 1500);
       return;
     }
-    wsGlobal.onopen = () => console.log("[WS global] opened");
+    wsGlobal.onopen = () => {
+      console.log("[WS global] opened");
+      reconnectHintMs = null;
+    };
     wsGlobal.onmessage = (e) => {
       try {
         const msg = JSON.parse(e.data);
+        if (isReconnectHint(msg)) return;
         if (msg.type === "notify") {
-          const senderId = msg.from_id;
-          if (!activeUser || activeUser.id !== senderId) {
-            unread[senderId] = (unread[senderId] || 0) + 1;
-            tryPlaySound();
-            tryShowSystemNotification({ user: msg.from_name, text: msg.text });
-            renderUsers();
-          }
+          handleNotify(msg);
+        } else if (msg.type === "notify_batch") {
+          // Sent once on connect: notifications missed while offline plus current unread counts
+          handleNotifyBatch(msg);
         } else if (msg.type === "unread_reset" && msg.from_id) {
           // Mark messages from this user as read
           unread[msg.from_id] = 0;
           renderUsers();
+        } else if (msg.type === "read" && msg.by_id) {
+          // Peer read my messages up to last_read_id
+          applyReadReceipt(msg.by_id, msg.last_read_id || 0);
         } else if (msg.type === "ping") {
           // Respond to ping to keep connection alive
           // Server uses this to detect if connection is still active
@@ -140,17 +213,92 @@ document.addEventListener("DOMContentLoaded", () => {
     };
     wsGlobal.onclose = () => {
       console.log("[WS global] closed, reconnecting...");
-      setTimeout(openGlobalWS, 1500);
+      setTimeout(openGlobalWS, reconnectDelay(1500));
     };
     wsGlobal.onerror = (e) => console.warn("[WS global] error", e);
   }
   openGlobalWS();
 
+  function handleNotify(msg) {
+    if (msg.ts) {
+      if (lastNotifyTs && msg.ts <= lastNotifyTs) return; // already seen
+      lastNotifyTs = msg.ts;
+    }
+    const senderId = msg.from_id;
+    ensureContact(senderId, msg.from_name, true);
+    if (!activeUser || activeUser.id !== senderId) {
+      unread[senderId] = (unread[senderId] || 0) + 1;
+      tryPlaySound();
+      tryShowSystemNotification({ user: msg.from_name, text: msg.text });
+      renderUsers();
+    }
+  }
+
+  function handleNotifyBatch(msg) {
+    const fresh = (msg.notifications || []).filter(n => !(n.ts && lastNotifyTs && n.ts <= lastNotifyTs));
+    for (const n of fresh) {
+      if (n.ts && (!lastNotifyTs || n.ts > lastNotifyTs)) lastNotifyTs = n.ts;
+      ensureContact(n.from_id, n.from_name);
+    }
+    // Counts already include these notifications, so they replace rather than increment
+    applyUnreadCounts(msg.unread || {});
+    const shown = fresh.filter(n => !activeUser || activeUser.id !== n.from_id);
+    if (shown.length) {
+      const last = shown[shown.length - 1];
+      tryPlaySound();
+      tryShowSystemNotification({
+        user: last.from_name,
+        text: shown.length > 1 ? `${last.text} (+${shown.length - 1})` : last.text
+      });
+    }
+  }
+
+  // ---- USER SEARCH ----
+  // Directory search (/api/users); while a query is active the list shows its results
+  const userSearch = document.getElementById("userSearch");
+  const SEARCH_PAGE = 20;
+  let searchResults = null; // null = show contacts
+  let searchCursor = null;
+  let searchSeq = 0;
+  let searchTimer;
+
+  async function searchUsers(query, cursor = null) {
+    const seq = ++searchSeq;
+    const params = new URLSearchParams({ q: query, limit: SEARCH_PAGE });
+    if (cursor) params.set("cursor", cursor);
+    try {
+      const res = await fetch(`/api/users?${params}`);
+      if (!res.ok || seq !== searchSeq) return;
+      const data = await res.json();
+      searchResults = (cursor && searchResults ? searchResults : []).concat(data.users);
+      searchCursor = data.next_cursor;
+      renderUsers();
+    } catch (err) {
+      console.warn("user search error", err);
+    }
+  }
+
+  if (userSearch) {
+    userSearch.addEventListener("input", () => {
+      clearTimeout(searchTimer);
+      const query = userSearch.value.trim();
+      if (!query) {
+        searchSeq++;
+        searchResults = null;
+        searchCursor = null;
+        renderUsers();
+        return;
+      }
+      searchTimer = setTimeout(() => searchUsers(query), 250);
+    });
+  }
+
   // ---- RENDER USERS LIST ----
   function renderUsers() {
     usersContainer.innerHTML = "";
 
-    const sorted = allUsers.slice().sort((a,b) => {
+    const searching = searchResults !== null;
+    const sorted = (searching ? searchResults : allUsers).slice().sort((a,b) => {
       if (a.name === username) return 1;
       if (b.name === username) return -1;
       if (a.online === b.online) return a.name.localeCompare(b.name);
@@ -206,10 +354,35 @@ document.addEventListener("DOMContentLoaded", () => {
 
       if (activeUser && activeUser.id === u.id) li.classList.add("active-user");
 
-      li.addEventListener("click", () => openChatWith(u));
+      li.addEventListener("click", () => {
+        if (searching) {
+          // Picked from search: becomes a contact, back to the contact list
+          const contact = ensureContact(u.id, u.name, u.online);
+          if (userSearch) userSearch.value = "";
+          searchResults = null;
+          searchCursor = null;
+          openChatWith(contact);
+        } else {
+          openChatWith(u);
+        }
+      });
       usersContainer.appendChild(li);
     }
 
+    if (searching && !searchResults.length) {
+      const empty = document.createElement("li");
+      empty.className = "users-list-note";
+      empty.textContent = "Никого не найдено";
+      usersContainer.appendChild(empty);
+    }
+    if (searching && searchCursor) {
+      const more = document.createElement("li");
+      more.className = "users-list-note";
+      more.textContent = "Показать ещё";
+      more.addEventListener("click", () => searchUsers(userSearch.value.trim(), searchCursor));
+      usersContainer.appendChild(more);
+    }
+
     updateTabTitleAndFavicon();
   }
 
@@ -337,52 +510,98 @@ document.addEventListener("DOMContentLoaded", () => {
       chatMessages.innerHTML = "";
     }
 
-    fetch(`/history/${myId}/${u.id}`)
+    loadChatHistory(u);
+
+    // создаём WS если его ещё нет
+    if (!wsChats[u.id]) {
+      connectChatWS(u);
+    }
+    // read cursor is advanced by loadChatHistory, up to the newest message it shows
+  }
+
+  // Mark messages from targetId up to lastId (the newest one shown) as read
+  // (server coalesces these and confirms with "unread_reset" over global WS)
+  function markChatRead(targetId, lastId) {
+    const myId = getCookie("user_id");
+    if (!myId || !lastId) return;
+    fetch(`/api/mark_read/${myId}/${targetId}?last_id=${lastId}`, { method: "POST" })
+      .then(() => {
+        unread[targetId] = 0;
+        renderUsers();
+      })
+      .catch(err => console.warn("mark_read error", err));
+  }
+
+  // Newest history page of a private chat; older pages load on scroll
+  function loadChatHistory(u) {
+    const myId = getCookie("user_id");
+    oldestLoadedId = null;
+    fetch(`/history/${myId}/${u.id}?limit=${HISTORY_PAGE}`)
       .then(r => r.json())
       .then(arr => {
+        if (!activeUser || activeUser.id !== u.id) return;
+        oldestLoadedId = arr.length === HISTORY_PAGE ? arr[0].id : null;
         if (chatMessages) {
           chatMessages.innerHTML = "";
           for (const m of arr) appendMessageToChat(m);
           chatMessages.scrollTop = chatMessages.scrollHeight;
         }
+        if (arr.length) {
+          lastChatIds[u.id] = Math.max(lastChatIds[u.id] || 0, arr[arr.length - 1].id || 0);
+          markChatRead(u.id, arr[arr.length - 1].id);
+        }
       })
       .catch(err => console.error("history fetch error", err));
+  }
 
-    // создаём WS если его ещё нет
-    if (!wsChats[u.id]) {
-      const url = `${wsProtocol}://${location.host}/ws/${myId}/${u.id}`;
-      console.log("[WS chat] opening", url);
-      const ws = new WebSocket(url);
-
-      ws.onopen = () => console.log("[WS chat] open", u.name);
-      ws.onmessage = (ev) => {
-        let msg;
-        try { msg = JSON.parse(ev.data); } catch (err) {
-          console.error("Invalid chat message", ev.data);
-          return;
-        }
-        handleIncomingMessage(msg);
-      };
-      ws.onclose = () => {
-        console.log("[WS chat] closed", u.name);
-        delete wsChats[u.id];
-      };
-      ws.onerror = (e) => console.error("[WS chat] error", e);
+  // Open private chat WS; on reconnect only messages after lastChatIds[u.id] are replayed
+  function connectChatWS(u) {
+    const myId = getCookie("user_id");
+    const since = lastChatIds[u.id] ? `?since=${lastChatIds[u.id]}` : "";
+    const url = `${wsProtocol}://${location.host}/ws/${myId}/${u.id}${since}`;
+    console.log("[WS chat] opening", url);
+    const ws = new WebSocket(url);
 
-      wsChats[u.id] = ws;
-    }
+    ws.onopen = () => console.log("[WS chat] open", u.name);
+    ws.onmessage = (ev) => {
+      let msg;
+      try { msg = JSON.parse(ev.data); } catch (err) {
+        console.error("Invalid chat message", ev.data);
+        return;
+      }
+      if (isReconnectHint(msg)) return;
+      if (msg.type === "error") {
+        showSendError(msg);
+        return;
+      }
+      // Too much missed to replay: reload the newest page (the gap loads on scroll)
+      if (msg.type === "replay" && msg.truncated) {
+        if (activeUser && activeUser.id === u.id) loadChatHistory(u);
+        return;
+      }
+      const batch = msg.type === "replay" ? (msg.messages || []) : [msg];
+      for (const m of batch) {
+        if (m.id) {
+          if (m.id <= (lastChatIds[u.id] || 0)) continue; // already shown
+          lastChatIds[u.id] = m.id;
+        }
+        handleIncomingMessage(m);
+      }
+    };
+    ws.onclose = () => {
+      console.log("[WS chat] closed", u.name);
+      const dropped = wsChats[u.id] === ws;
+      if (dropped) delete wsChats[u.id];
+      // Unexpected drop of the open chat: reconnect and resume from last seen id
+      if (dropped && activeUser && activeUser.id === u.id) {
+        setTimeout(() => {
+          if (activeUser && activeUser.id === u.id && !wsChats[u.id]) connectChatWS(u);
+        }, reconnectDelay(1500));
+      }
+    };
+    ws.onerror = (e) => console.error("[WS chat] error", e);
 
-    // mark read immediately and update unread count
-    fetch(`/api/mark_read/${myId}/${u.id}`, { method: "POST" })
-      .then(res => res.json())
-      .then(() => {
-        // Immediately update unread count for this user
-        unread[u.id] = 0;
-        renderUsers();
-        // Also refresh from DB after a short delay to ensure consistency
-        setTimeout(loadUnreadFromDB, 500);
-      })
-      .catch(err => console.warn("mark_read error", err));
+    wsChats[u.id] = ws;
   }
 
   // ---- MESSAGE HANDLING ----
@@ -402,16 +621,7 @@ document.addEventListener("DOMContentLoaded", () => {
       appendMessageToChat(msg);
       // If this is a new message (not from history) and not from self, mark as read
       if (!isFromSelf && activeUser && senderId === activeUser.id) {
-        const myId = getCookie("user_id");
-        if (myId) {
-          // Mark as read in background
-          fetch(`/api/mark_read/${myId}/${senderId}`, { method: "POST" })
-            .then(() => {
-              unread[senderId] = 0;
-              renderUsers();
-            })
-            .catch(err => console.warn("mark_read error", err));
-        }
+        markChatRead(senderId, msg.id);
       }
     } else {
       // Message is not in active chat - increment unread
@@ -428,7 +638,15 @@ document.addEventListener("DOMContentLoaded", () => {
 
   function appendMessageToChat(msg) {
     if (!chatMessages) return;
+    chatMessages.appendChild(buildMessageRow(msg));
     
+    // Smooth scroll to bottom
+    setTimeout(() => {
+      chatMessages.scrollTop = chatMessages.scrollHeight;
+    }, 50);
+  }
+
+  function buildMessageRow(msg) {
     const isSelf = (msg.user === username);
     const divWrap = document.createElement("div");
     divWrap.className = "message-row";
@@ -446,20 +664,86 @@ document.addEventListener("DOMContentLoaded", () => {
     const time = document.createElement("div");
     time.className = "msg-time";
     time.textContent = msg.time || "";
+    if (isSelf && msg.id) {
+      // ✓ sent, ✓✓ read by the peer
+      bubble.dataset.id = msg.id;
+      const status = document.createElement("span");
+      status.className = "msg-status";
+      time.appendChild(status);
+      setReadStatus(bubble, activeUser && msg.id <= (peerReadIds[activeUser.id] || 0));
+    }
 
     main.appendChild(text);
     bubble.appendChild(main);
     bubble.appendChild(time);
     divWrap.appendChild(bubble);
-    chatMessages.appendChild(divWrap);
-    
-    // Smooth scroll to bottom
-    setTimeout(() => {
-      chatMessages.scrollTop = chatMessages.scrollHeight;
-    }, 50);
+    return divWrap;
+  }
+
+  function setReadStatus(bubble, read) {
+    const status = bubble.querySelector(".msg-status");
+    if (!status) return;
+    status.textContent = read ? " ✓✓" : " ✓";
+    status.classList.toggle("read", read);
+  }
+
+  function applyReadReceipt(peerId, lastReadId) {
+    if (lastReadId <= (peerReadIds[peerId] || 0)) return;
+    peerReadIds[peerId] = lastReadId;
+    if (!chatMessages || activeRoom || !activeUser || activeUser.id !== peerId) return;
+    for (const bubble of chatMessages.querySelectorAll(".message-self[data-id]")) {
+      if (Number(bubble.dataset.id) <= lastReadId) setReadStatus(bubble, true);
+    }
+  }
+
+  // Prepend the page before oldestLoadedId of the open chat/room, keeping the scroll position
+  function loadOlderMessages() {
+    if (loadingOlder || !oldestLoadedId || !chatMessages) return;
+    const myId = getCookie("user_id");
+    const room = activeRoom;
+    const user = activeUser;
+    let url;
+    if (room) url = `/api/rooms/${room.id}/history`;
+    else if (user && myId) url = `/history/${myId}/${user.id}`;
+    else return;
+    loadingOlder = true;
+    fetch(`${url}?limit=${HISTORY_PAGE}&before=${oldestLoadedId}`)
+      .then(r => r.json())
+      .then(arr => {
+        if (activeRoom !== room || activeUser !== user) return; // switched chats meanwhile
+        oldestLoadedId = arr.length === HISTORY_PAGE ? arr[0].id : null;
+        const rows = document.createDocumentFragment();
+        for (const m of arr) rows.appendChild(room ? buildRoomMessageRow(m) : buildMessageRow(m));
+        const previousHeight = chatMessages.scrollHeight;
+        chatMessages.insertBefore(rows, chatMessages.firstChild);
+        chatMessages.scrollTop += chatMessages.scrollHeight - previousHeight;
+      })
+      .catch(err => console.error("older history error", err))
+      .finally(() => { loadingOlder = false; });
+  }
+
+  if (chatMessages) {
+    chatMessages.addEventListener("scroll", () => {
+      if (chatMessages.scrollTop < 80) loadOlderMessages();
+    });
   }
 
   // ---- SEND MESSAGE ----
+  // Server dropped a message (rate limit or size cap)
+  function showSendError(msg) {
+    if (msg.error === "message_too_long") {
+      console.warn(`[SEND] Message too long (max ${msg.max_length} characters)`);
+    } else if (msg.error === "rate_limited") {
+      console.warn(`[SEND] Sending too fast, retry in ${msg.retry_after_ms} ms`);
+    } else {
+      console.warn("[SEND] Message rejected:", msg.error);
+    }
+    if (sendBtn) sendBtn.classList.add("btn-warning");
+    setTimeout(() => {
+      if (sendBtn) sendBtn.classList.remove("btn-warning");
+    }, 500);
+  }
+
   function sendMessage() {
     const txt = (input.value || "").trim();
     if (!txt) {
@@ -630,6 +914,7 @@ document.addEventListener("DOMContentLoaded", () => {
   let allRooms = [];
   let activeRoom = null;
   const wsRooms = {}; // {room_id: websocket}
+  let managedRoomId = null; // room currently shown in the management modal
   
   // Color palette for room messages
   const roomMessageColors = [
@@ -684,17 +969,8 @@ document.addEventListener("DOMContentLoaded", () => {
       
       const infoDiv = document.createElement("div");
       infoDiv.className = "room-info";
-      // Get actual member count from API - update room data
-      fetch(`/api/rooms/${room.id}/members`)
-        .then(r => r.json())
-        .then(members => {
-          const actualCount = members.length;
-          room.member_count = actualCount; // Update room object
-          infoDiv.innerHTML = `<span>${room.creator_name}</span> • <span>${actualCount} участников</span>`;
-        })
-        .catch(() => {
-          infoDiv.innerHTML = `<span>${room.creator_name}</span> • <span>${room.member_count} участников</span>`;
-        });
+      // member_count comes from /api/rooms and is kept current by "members" events
+      infoDiv.innerHTML = `<span>${room.creator_name}</span> • <span>${room.member_count} участников</span>`;
       
       const actionsDiv = document.createElement("div");
       actionsDiv.className = "room-actions";
@@ -771,17 +1047,7 @@ document.addEventListener("DOMContentLoaded", () => {
     }
     hideReplyIndicator(); // Clear reply when switching chats
     
-    // Load history
-    fetch(`/api/rooms/${room.id}/history`)
-      .then(r => r.json())
-      .then(arr => {
-        if (chatMessages) {
-          chatMessages.innerHTML = "";
-          for (const m of arr) appendRoomMessageToChat(m);
-          chatMessages.scrollTop = chatMessages.scrollHeight;
-        }
-      })
-      .catch(err => console.error("room history error", err));
+    loadRoomHistory(room);
     
     // Open WebSocket
     if (!wsRooms[room.id] || wsRooms[room.id].readyState !== WebSocket.OPEN) {
@@ -793,42 +1059,104 @@ document.addEventListener("DOMContentLoaded", () => {
         delete wsRooms[room.id];
       }
       
-      const url = `${wsProtocol}://${location.host}/ws/room/${room.id}/${myId}`;
-      console.log("[WS room] Opening connection to:", url);
-      const ws = new WebSocket(url);
-      
-      ws.onopen = () => {
-        console.log("[WS room] open", room.name, "State:", ws.readyState);
-      };
-      ws.onmessage = (ev) => {
-        let msg;
-        try { msg = JSON.parse(ev.data); } catch (err) {
-          console.error("[WS room] Invalid room message", ev.data, err);
-          return;
-        }
-        // Ensure this is a room message
-        if (msg.room_id) {
-          appendRoomMessageToChat(msg);
-        }
-      };
-      ws.onclose = (event) => {
-        console.log("[WS room] closed", room.name, "Code:", event.code, "Reason:", event.reason);
-        delete wsRooms[room.id];
-      };
-      ws.onerror = (e) => {
-        console.error("[WS room] error", room.name, e);
-      };
-      
-      wsRooms[room.id] = ws;
+      connectRoomWS(room);
     } else {
       console.log("[WS room] Connection already open for", room.name);
     }
   }
   
+  // Newest history page of a room; older pages load on scroll
+  function loadRoomHistory(room) {
+    oldestLoadedId = null;
+    fetch(`/api/rooms/${room.id}/history?limit=${HISTORY_PAGE}`)
+      .then(r => r.json())
+      .then(arr => {
+        if (!activeRoom || activeRoom.id !== room.id) return;
+        oldestLoadedId = arr.length === HISTORY_PAGE ? arr[0].id : null;
+        if (chatMessages) {
+          chatMessages.innerHTML = "";
+          for (const m of arr) appendRoomMessageToChat(m);
+          chatMessages.scrollTop = chatMessages.scrollHeight;
+        }
+        if (arr.length) {
+          lastRoomIds[room.id] = Math.max(lastRoomIds[room.id] || 0, arr[arr.length - 1].id || 0);
+        }
+      })
+      .catch(err => console.error("room history error", err));
+  }
+  
+  // Open room WS; on reconnect only messages after lastRoomIds[room.id] are replayed
+  function connectRoomWS(room) {
+    const myId = getCookie("user_id");
+    const since = lastRoomIds[room.id] ? `?since=${lastRoomIds[room.id]}` : "";
+    const url = `${wsProtocol}://${location.host}/ws/room/${room.id}/${myId}${since}`;
+    console.log("[WS room] Opening connection to:", url);
+    const ws = new WebSocket(url);
+    
+    ws.onopen = () => {
+      console.log("[WS room] open", room.name, "State:", ws.readyState);
+    };
+    ws.onmessage = (ev) => {
+      let msg;
+      try { msg = JSON.parse(ev.data); } catch (err) {
+        console.error("[WS room] Invalid room message", ev.data, err);
+        return;
+      }
+      if (isReconnectHint(msg)) return;
+      if (msg.type === "error") {
+        showSendError(msg);
+        return;
+      }
+      // Membership changed (bulk add/remove)
+      if (msg.type === "members") {
+        applyRoomMembers(msg.room_id, msg.members, msg.removed || []);
+        return;
+      }
+      // Too much missed to replay: reload the newest page (the gap loads on scroll)
+      if (msg.type === "replay" && msg.truncated) {
+        if (activeRoom && activeRoom.id === room.id) loadRoomHistory(room);
+        return;
+      }
+      const batch = msg.type === "replay" ? (msg.messages || []) : [msg];
+      for (const m of batch) {
+        // Ensure this is a room message
+        if (!m.room_id) continue;
+        if (m.id) {
+          if (m.id <= (lastRoomIds[room.id] || 0)) continue; // already shown
+          lastRoomIds[room.id] = m.id;
+        }
+        appendRoomMessageToChat(m);
+      }
+    };
+    ws.onclose = (event) => {
+      console.log("[WS room] closed", room.name, "Code:", event.code, "Reason:", event.reason);
+      const dropped = wsRooms[room.id] === ws;
+      if (dropped) delete wsRooms[room.id];
+      // Unexpected drop of the open room (not a membership/access close): resume from last seen id
+      if (dropped && event.code !== 1008 && activeRoom && activeRoom.id === room.id) {
+        setTimeout(() => {
+          if (activeRoom && activeRoom.id === room.id && !wsRooms[room.id]) connectRoomWS(room);
+        }, reconnectDelay(1500));
+      }
+    };
+    ws.onerror = (e) => {
+      console.error("[WS room] error", room.name, e);
+    };
+    
+    wsRooms[room.id] = ws;
+  }
+  
   // Append room message
   function appendRoomMessageToChat(msg) {
     if (!chatMessages) return;
+    chatMessages.appendChild(buildRoomMessageRow(msg));
     
+    setTimeout(() => {
+      chatMessages.scrollTop = chatMessages.scrollHeight;
+    }, 50);
+  }
+  
+  function buildRoomMessageRow(msg) {
     const myId = getCookie("user_id");
     const isSelf = (msg.sender_id === myId);
     const color = getSenderColor(msg.sender_id);
@@ -899,11 +1227,7 @@ document.addEventListener("DOMContentLoaded", () => {
     bubble.appendChild(main);
     bubble.appendChild(time);
     divWrap.appendChild(bubble);
-    chatMessages.appendChild(divWrap);
-    
-    setTimeout(() => {
-      chatMessages.scrollTop = chatMessages.scrollHeight;
-    }, 50);
+    return divWrap;
   }
   
   // Create room
@@ -993,14 +1317,17 @@ document.addEventListener("DOMContentLoaded", () => {
   }
   
   // Open room management
-  async function openRoomManage(room) {
+  async function openRoomManage(room, members = null) {
     const myId = getCookie("user_id");
-    if (room.creator_id !== myId) return;
+    if (!room || room.creator_id !== myId) return;
+    managedRoomId = room.id;
     
     try {
-      const membersRes = await fetch(`/api/rooms/${room.id}/members`);
-      if (!membersRes.ok) return;
-      const members = await membersRes.json();
+      if (!members) {
+        const membersRes = await fetch(`/api/rooms/${room.id}/members`);
+        if (!membersRes.ok) return;
+        members = await membersRes.json();
+      }
       
       const title = document.getElementById("roomManageTitle");
       const content = document.getElementById("roomManageContent");
@@ -1024,56 +1351,102 @@ document.addEventListener("DOMContentLoaded", () => {
             `).join("")}
           </ul>
           <p><strong>Добавить пользователя:</strong></p>
-          <select id="addUserSelect" style="width: 100%; padding: 8px; margin-bottom: 12px;">
-            <option value="">Выберите пользователя</option>
-            ${allUsers.filter(u => !members.find(m => m.id === u.id)).map(u => 
-              `<option value="${u.id}">${u.name}</option>`
-            ).join("")}
+          <input type="search" id="addUserSearch" placeholder="Поиск по имени..." autocomplete="off">
+          <select id="addUserSelect" multiple size="6" style="width: 100%; padding: 8px; margin-bottom: 12px;">
           </select>
           <button class="btn-primary" onclick="addUserToRoom('${room.id}')" style="width: 100%;">Добавить</button>
         `;
       }
       
+      // Contacts first; typing searches the whole directory
+      const memberIds = new Set(members.map(m => m.id));
+      fillAddUserOptions(allUsers, memberIds);
+      const addSearch = document.getElementById("addUserSearch");
+      let addSearchTimer;
+      addSearch?.addEventListener("input", () => {
+        clearTimeout(addSearchTimer);
+        const query = addSearch.value.trim();
+        if (!query) {
+          fillAddUserOptions(allUsers, memberIds);
+          return;
+        }
+        addSearchTimer = setTimeout(async () => {
+          try {
+            const res = await fetch(`/api/users?${new URLSearchParams({ q: query, limit: 50 })}`);
+            if (!res.ok || addSearch.value.trim() !== query) return;
+            fillAddUserOptions((await res.json()).users, memberIds);
+          } catch (err) {
+            console.warn("user search error", err);
+          }
+        }, 250);
+      });
+      
       roomManageModalOverlay?.classList.add("active");
     } catch (err) {
       console.error("Error loading room members:", err);
     }
   }
   
-  // Add user to room
+  function fillAddUserOptions(users, memberIds) {
+    const select = document.getElementById("addUserSelect");
+    if (!select) return;
+    select.innerHTML = "";
+    for (const u of users) {
+      if (memberIds.has(u.id) || u.name === username) continue;
+      const option = document.createElement("option");
+      option.value = u.id;
+      option.textContent = u.name;
+      select.appendChild(option);
+    }
+  }
+  
+  // Apply a fresh member list for a room (from bulk API response or "members" event)
+  function applyRoomMembers(roomId, members, removed) {
+    const myId = getCookie("user_id");
+    if (removed.includes(myId)) {
+      // We were removed from this room
+      allRooms = allRooms.filter(r => r.id !== roomId);
+      if (activeRoom && activeRoom.id === roomId) {
+        activeRoom = null;
+        if (chatMessages) chatMessages.innerHTML = "";
+        if (chatContainer) {
+          chatContainer.classList.remove("has-active-chat");
+          chatContainer.classList.remove("has-active-room");
+        }
+      }
+      renderRooms();
+      return;
+    }
+    const room = allRooms.find(r => r.id === roomId);
+    if (!room) return;
+    room.member_count = members.length;
+    renderRooms();
+    if (managedRoomId === roomId && roomManageModalOverlay?.classList.contains("active")) {
+      openRoomManage(room, members);
+    }
+  }
+  
+  // Apply a bulk membership change and refresh UI from the returned member list
+  async function changeRoomMembers(roomId, action, userIds) {
+    const res = await fetch(`/api/rooms/${roomId}/${action}`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ user_ids: userIds })
+    });
+    if (!res.ok) return false;
+    const data = await res.json();
+    applyRoomMembers(roomId, data.members, data.removed || []);
+    return true;
+  }
+  
+  // Add selected users to room
   window.addUserToRoom = async function(roomId) {
     const select = document.getElementById("addUserSelect");
-    const userId = select?.value;
-    if (!userId) return;
+    const userIds = select ? Array.from(select.selectedOptions, o => o.value).filter(Boolean) : [];
+    if (!userIds.length) return;
     
     try {
-      const res = await fetch(`/api/rooms/${roomId}/add_user`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ user_id: userId })
-      });
-      
-      if (res.ok) {
-        await loadRooms();
-        // Refresh the specific room's member count
-        const updatedRoom = allRooms.find(r => r.id === roomId);
-        if (updatedRoom) {
-          fetch(`/api/rooms/${roomId}/members`)
-            .then(r => r.json())
-            .then(members => {
-              updatedRoom.member_count = members.length;
-              renderRooms();
-            });
-        }
-        // Update active room if it's the one being modified
-        if (activeRoom && activeRoom.id === roomId) {
-          activeRoom = updatedRoom;
-          if (activeRoom && chatHeader) {
-            updateRoomHeader(activeRoom);
-          }
-        }
-        openRoomManage(updatedRoom);
-      } else {
+      if (!(await changeRoomMembers(roomId, "add_users", userIds))) {
         alert("Ошибка добавления пользователя");
       }
     } catch (err) {
@@ -1087,33 +1460,7 @@ document.addEventListener("DOMContentLoaded", () => {
     if (!confirm("Удалить пользователя из комнаты?")) return;
     
     try {
-      const res = await fetch(`/api/rooms/${roomId}/remove_user`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ user_id: userId })
-      });
-      
-      if (res.ok) {
-        await loadRooms();
-        // Refresh the specific room's member count
-        const updatedRoom = allRooms.find(r => r.id === roomId);
-        if (updatedRoom) {
-          fetch(`/api/rooms/${roomId}/members`)
-            .then(r => r.json())
-            .then(members => {
-              updatedRoom.member_count = members.length;
-              renderRooms();
-            });
-        }
-        // Update active room if it's the one being modified
-        if (activeRoom && activeRoom.id === roomId) {
-          activeRoom = updatedRoom;
-          if (activeRoom && chatHeader) {
-            updateRoomHeader(activeRoom);
-          }
-        }
-        openRoomManage(updatedRoom);
-      } else {
+      if (!(await changeRoomMembers(roomId, "remove_users", [userId]))) {
         alert("Ошибка удаления пользователя");
       }
     } catch (err) {
@@ -1230,8 +1577,8 @@ document.addEventListener("DOMContentLoaded", () => {
   // ---- INIT ----
   renderUsers();
   loadRooms();
-  openGlobalWS(); // Open global WebSocket for notifications
-  setTimeout(loadUnreadFromDB, 800);
-  setInterval(loadUnreadFromDB, 10000);
+  // Unread counts arrive with the notify_batch frame on global WS connect;
+  // polling only guards against drift
+  setInterval(loadUnreadFromDB, 60000);
   setInterval(loadRooms, 30000); // Refresh rooms every 30 seconds
 });